@@ -13,6 +13,8 @@ Spiders = [
     'XLU', # Utilities
     'XLV', # Healthcare
 ]   
+SPY = ['SPY']
+USAssetClasses = ['XLB', 'XLE'] # adjust
 
 
 Curr_dict = {
@@ -0,0 +1,196 @@
+'''
+Optional asyncio engine for Alpaca historical market data (v2 REST API) used by MyAlpaca.get_history(engine='async').
+- one aiohttp session with a pooled keep-alive connector, owned by an event loop in a background thread, reused by all calls
+- next_page_token chains (see hist_data_v2 in Snips_Alpaca_API.py) run concurrently: the requested window is cut into time slices,
+  each slice follows its own page chain
+- JSON is parsed straight into per-field lists/arrays, no pydantic models per bar
+Requires aiohttp (pip install aiohttp); orjson is used for parsing if installed.
+'''
+import asyncio
+import json
+import math
+import threading
+
+import numpy as np
+import pandas as pd
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+DATA_URL = 'https://data.alpaca.markets/v2/stocks'
+
+# API field -> column name as in the alpaca-py .df frames (after reset_index)
+BAR_FIELDS = {'t': 'timestamp', 'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume', 'n': 'trade_count', 'vw': 'vwap'}
+QUOTE_FIELDS = {'t': 'timestamp', 'ax': 'ask_exchange', 'ap': 'ask_price', 'as': 'ask_size', 'bx': 'bid_exchange', 'bp': 'bid_price', 'bs': 'bid_size', 'c': 'conditions', 'z': 'tape'}
+TRADE_FIELDS = {'t': 'timestamp', 'x': 'exchange', 'p': 'price', 's': 'size', 'i': 'id', 'c': 'conditions', 'z': 'tape'}
+NUMERIC_COLUMNS = {'open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap', 'ask_price', 'ask_size', 'bid_price', 'bid_size', 'price', 'size'}
+
+
+class MarketDataHTTPError(Exception):
+    '''non-200 answer; status_code 429 is picked up by the download tuner in utils_for_alpaca'''
+
+    def __init__(self, status_code, message):
+        super().__init__(f'HTTP {status_code}: {message}')
+        self.status_code = status_code
+
+
+def _rfc3339(value):
+    ts = pd.Timestamp(value)
+    ts = ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
+    return ts.strftime('%Y-%m-%dT%H:%M:%S.%fZ' if ts.microsecond else '%Y-%m-%dT%H:%M:%SZ')
+
+
+def _time_slices(start, end, slice_days, gap=pd.Timedelta(seconds=1)):
+    '''
+    start till end cut into slice_days long windows on whole seconds, each paginated on its own. The API end is inclusive,
+    so every window but the last ends gap before the next one starts (no record is in two windows); gap: resolution of the
+    timestamps (bars: a second, quotes and trades: a microsecond)
+    '''
+    start, end = pd.Timestamp(start).floor('s'), pd.Timestamp(end).floor('s')
+    if slice_days is None:
+        return [(start, end)]
+    n_slices = max(1, math.ceil((end - start) / pd.Timedelta(days=slice_days)))
+    edges = [(start + (end - start) * i / n_slices).floor('s') for i in range(n_slices + 1)]
+    return [(slice_start, next_start - gap) for slice_start, next_start in zip(edges[:-1], edges[1:-1])] + [(edges[-2], end)]
+
+
+class _Columns:
+    '''per-field python lists filled page by page, turned into one frame at the end'''
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.symbols = []
+        self.values = {column: [] for column in fields.values()}
+
+
+    def add(self, records_by_symbol):
+        for symbol, records in (records_by_symbol or {}).items():
+            self.symbols.extend([symbol] * len(records))
+            for field, column in self.fields.items():
+                self.values[column].extend([r.get(field) for r in records])
+
+
+    def frame(self):
+        df = pd.DataFrame({'symbol': self.symbols})
+        for column, values in self.values.items():
+            if column == 'timestamp':
+                df[column] = pd.to_datetime(values, utc=True, format='ISO8601')
+            elif column in NUMERIC_COLUMNS:
+                df[column] = np.array(values, dtype=float)
+            else:
+                df[column] = values
+        return df
+
+
+class AsyncMarketData:
+
+    def __init__(self, key, secret, max_connections=16, feed='sip', page_limit=10000, rate_limiter=None):
+        if aiohttp is None:
+            raise ImportError("engine='async' needs aiohttp: pip install aiohttp")
+        self.headers = {'APCA-API-KEY-ID': key, 'APCA-API-SECRET-KEY': secret, 'Accept': 'application/json'}
+        self.max_connections = max_connections
+        self.feed = feed
+        self.page_limit = page_limit
+        self.rate_limiter = rate_limiter # utils_for_alpaca.RateLimiter shared with the SDK clients
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True, name='alpaca-async-data').start()
+        self.session = self._run(self._open_session())
+
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+        self.semaphore = asyncio.Semaphore(self.max_connections)
+        return aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=aiohttp.ClientTimeout(total=120))
+
+
+    def _run(self, coroutine):
+        '''blocks the calling (e.g. download worker) thread until the coroutine is done on the engine loop'''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+    def close(self):
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+    async def _get(self, url, params):
+        async with self.semaphore:
+            if self.rate_limiter is not None: # blocking acquire runs in the default executor, not on the loop
+                await asyncio.get_running_loop().run_in_executor(None, self.rate_limiter.acquire, self.rate_limiter.request_priority('GET', url))
+            async with self.session.get(url, params=params) as response:
+                body = await response.read()
+                if response.status == 429 and self.rate_limiter is not None:
+                    self.rate_limiter.throttled()
+                if response.status != 200:
+                    raise MarketDataHTTPError(response.status, body[:200].decode(errors='replace'))
+                return _loads(body)
+
+
+    async def _paginate(self, url, params, key, columns):
+        '''one page_token chain; records go straight into the shared columns'''
+        params = dict(params)
+        while True:
+            page = await self._get(url, params)
+            columns.add(page.get(key))
+            if not page.get('next_page_token'):
+                return
+            params['page_token'] = page['next_page_token']
+
+
+    async def _historical(self, endpoint, key, fields, symbols, start, end, extra_params, slice_days):
+        columns = _Columns(fields)
+        base_params = {'symbols': ','.join(symbols), 'limit': self.page_limit, 'feed': self.feed, **extra_params}
+        gap = pd.Timedelta(seconds=1) if endpoint == 'bars' else pd.Timedelta(microseconds=1)
+        await asyncio.gather(*[
+            self._paginate(f'{DATA_URL}/{endpoint}', {**base_params, 'start': _rfc3339(slice_start), 'end': _rfc3339(slice_end)}, key, columns)
+            for slice_start, slice_end in _time_slices(start, end, slice_days, gap)
+        ])
+        df = columns.frame()
+        if endpoint == 'bars': # one bar per symbol and time; quotes and trades may share a timestamp
+            df = df.drop_duplicates(['symbol', 'timestamp'], ignore_index=True)
+        return df.sort_values(['symbol', 'timestamp'], kind='stable', ignore_index=True) # slices finish in any order
+
+
+    def get_bars(self, symbols, start, end, timeframe='1Day', adjustment='all', slice_days=None):
+        '''same columns as StockHistoricalDataClient.get_stock_bars(...).df.reset_index(); timeframe like '5Min', '1Hour', '1Day' '''
+        return self._run(self._historical('bars', 'bars', BAR_FIELDS, symbols, start, end, {'timeframe': timeframe, 'adjustment': adjustment}, slice_days))
+
+
+    def get_quotes(self, symbols, start, end, slice_days=None):
+        return self._run(self._historical('quotes', 'quotes', QUOTE_FIELDS, symbols, start, end, {}, slice_days))
+
+
+    def get_trades(self, symbols, start, end, slice_days=None):
+        return self._run(self._historical('trades', 'trades', TRADE_FIELDS, symbols, start, end, {}, slice_days))
+
+
+    def get_snapshots(self, symbols, chunk_size=1000):
+        '''one row per symbol: latest trade/quote, today's and previous daily bar (flat columns)'''
+
+        async def fetch_all():
+            chunks = [symbols[i:i + chunk_size] for i in range(0, len(symbols), chunk_size)]
+            pages = await asyncio.gather(*[self._get(f'{DATA_URL}/snapshots', {'symbols': ','.join(chunk), 'feed': self.feed}) for chunk in chunks])
+            rows = []
+            for page in pages:
+                for symbol, snap in page.items():
+                    if not snap:
+                        continue
+                    trade, quote = snap.get('latestTrade') or {}, snap.get('latestQuote') or {}
+                    daily, prev_daily = snap.get('dailyBar') or {}, snap.get('prevDailyBar') or {}
+                    rows.append((symbol, trade.get('t'), trade.get('p'), quote.get('bp'), quote.get('ap'),
+                                 daily.get('o'), daily.get('h'), daily.get('l'), daily.get('c'), daily.get('v'), prev_daily.get('c')))
+            return rows
+
+        df = pd.DataFrame(self._run(fetch_all()), columns=['symbol', 'latest_trade_timestamp', 'latest_trade_price', 'bid_price', 'ask_price',
+                                                           'daily_open', 'daily_high', 'daily_low', 'daily_close', 'daily_volume', 'prev_daily_close'])
+        df['latest_trade_timestamp'] = pd.to_datetime(df['latest_trade_timestamp'], utc=True, format='ISO8601')
+        return df
@@ -0,0 +1,649 @@
+'''
+Vectorized helpers for long-format bar frames (one row per symbol and timestamp) as returned by MyAlpaca.get_history.
+Only numpy and pandas are needed here (no alpaca/github imports), so the functions could be timed in bench_bar_kernels.py.
+Loop kernels are compiled with numba if it is installed (pip install numba), otherwise the numpy versions run.
+'''
+import atexit
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _jit(func):
+    return numba.njit(cache=True, nogil=True)(func) if numba is not None else None
+
+
+def symbol_blocks(df):
+    '''
+    (codes, starts, ends) if every symbol sits in one contiguous block of rows, else None.
+    codes are the positions of symbols in the sorted unique symbols. get_stock_bars returns bars like this (chunks concatenated).
+    '''
+    codes, uniques = pd.factorize(df['symbol'], sort=True)
+    if len(codes) == 0:
+        return None
+    boundaries = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(codes)]))
+    if len(starts) != len(uniques):
+        return None
+    return codes, starts, ends
+
+
+def last_n_per_symbol(df, n, time_column='timestamp', max_histogram_cells=50_000_000):
+    '''
+    Replacement of df.groupby('symbol', group_keys=False).apply(lambda x: x.nlargest(n, 'timestamp')):
+    symbols ascending, within a symbol the n latest rows with newest first. Duplicated timestamps (not returned by the API) keep
+    their original order; nlargest does the same unless n covers the whole symbol.
+    No python callback per symbol:
+    - frames as they come from the API (one block per symbol, strictly increasing timestamps) only need positional tails of the blocks
+    - otherwise a symbol x timestamp histogram gives every symbol's n-th latest timestamp, and only rows from there on are sorted
+      (stable sort plus cumcount mask; the whole frame is sorted if the histogram would be bigger than max_histogram_cells)
+    '''
+    timestamps = np.asarray(df[time_column].values)
+    if timestamps.dtype.kind != 'M' or df.empty:
+        return _sorted_last_n(df, n, time_column)
+
+    blocks = symbol_blocks(df)
+    if blocks is not None:
+        codes, starts, ends = blocks
+        increasing = np.diff(timestamps.view('i8')) > 0
+        increasing[ends[:-1] - 1] = True # block boundaries do not count
+        if increasing.all():
+            block_order = np.argsort(codes[starts]) # blocks by symbol
+            tail_lengths = np.minimum(n, ends - starts)[block_order]
+            offsets = np.arange(tail_lengths.sum()) - np.repeat(np.cumsum(tail_lengths) - tail_lengths, tail_lengths)
+            rows = np.repeat(ends[block_order] - 1, tail_lengths) - offsets # last row of the block first
+            return df.iloc[rows]
+    else:
+        codes = pd.factorize(df['symbol'], sort=True)[0]
+
+    time_ranks, unique_times = pd.factorize(timestamps.view('i8'), sort=True)
+    n_symbols = codes.max() + 1
+    if n_symbols * len(unique_times) > max_histogram_cells:
+        return _sorted_last_n(df, n, time_column)
+    counts = np.bincount(codes.astype(np.int64) * len(unique_times) + time_ranks, minlength=n_symbols * len(unique_times))
+    rows_from_newest = np.cumsum(counts.reshape(n_symbols, len(unique_times))[:, ::-1], axis=1)
+    reached = rows_from_newest >= n
+    cutoff = len(unique_times) - 1 - np.where(reached.any(axis=1), reached.argmax(axis=1), len(unique_times) - 1)
+    return _sorted_last_n(df[time_ranks >= cutoff[codes]], n, time_column)
+
+
+def _sorted_last_n(df, n, time_column):
+    ordered = df.sort_values(['symbol', time_column], ascending=[True, False], kind='stable')
+    return ordered[ordered.groupby('symbol', sort=False, observed=True).cumcount().to_numpy() < n]
+
+
+NS_PER_MINUTE = 60 * 10**9
+NS_PER_DAY = 1440 * NS_PER_MINUTE
+
+
+@functools.lru_cache(maxsize=None)
+def _utc_offset_table(tz='America/New_York', first_year=1990, last_year=2050):
+    '''(transition instants as UTC ns, utc offset in ns from that instant on); DST switches happen on full UTC hours'''
+    hours = pd.date_range(f'{first_year}-01-01', f'{last_year}-12-31', freq='h', tz='UTC')
+    utc_ns = hours.as_unit('ns').asi8
+    offsets = hours.tz_convert(tz).tz_localize(None).as_unit('ns').asi8 - utc_ns
+    changes = np.concatenate(([0], np.flatnonzero(np.diff(offsets)) + 1))
+    transitions = utc_ns[changes]
+    transitions[0] = np.iinfo(np.int64).min # first offset also applies before the table
+    return transitions, offsets[changes]
+
+
+def to_ny_local(timestamps):
+    '''
+    tz-aware timestamps => naive New York wall-clock datetime64[ns], like .dt.tz_convert('America/New_York').dt.tz_localize(None)
+    but as one int64 add with offsets looked up in a precomputed DST table.
+    '''
+    utc_ns = pd.DatetimeIndex(timestamps).as_unit('ns').asi8
+    transitions, offsets = _utc_offset_table()
+    local_ns = utc_ns + offsets[np.searchsorted(transitions, utc_ns, side='right') - 1]
+    return local_ns.view('datetime64[ns]')
+
+
+def regular_session_mask(local_times, sessions=None, open_minute=9 * 60 + 30, close_minute=16 * 60):
+    '''
+    True for naive ET timestamps inside the regular session, both ends inclusive as in time.between('09:30', '16:00').
+    sessions is a calendar frame (date, open, close as naive ET) like TradingCalendar.sessions returns:
+    early closes use their own close, days of the calendar range without a session are excluded.
+    Without sessions every day uses open_minute..close_minute. Only integer compares on ns-of-day, no python time objects.
+    '''
+    local_ns = np.asarray(local_times).astype('datetime64[ns]').view('i8')
+    if len(local_ns) == 0:
+        return np.zeros(0, dtype=bool)
+    days = local_ns // NS_PER_DAY
+    ns_of_day = local_ns - days * NS_PER_DAY
+    if sessions is None or len(sessions) == 0:
+        return (ns_of_day >= open_minute * NS_PER_MINUTE) & (ns_of_day <= close_minute * NS_PER_MINUTE)
+
+    first_day = days.min()
+    n_days = days.max() - first_day + 1
+    open_ns = np.full(n_days, open_minute * NS_PER_MINUTE, dtype=np.int64)
+    close_ns = np.full(n_days, close_minute * NS_PER_MINUTE, dtype=np.int64)
+    session_days = pd.to_datetime(sessions['date']).values.astype('datetime64[D]').astype(np.int64) - first_day
+    covered_from, covered_to = max(0, session_days.min()), min(n_days - 1, session_days.max())
+    if covered_from <= covered_to:
+        close_ns[covered_from:covered_to + 1] = -1 # calendar days without a session
+    inside = (session_days >= 0) & (session_days < n_days)
+    session_open = pd.to_datetime(sessions['open']).values.astype('datetime64[ns]').view('i8')
+    session_close = pd.to_datetime(sessions['close']).values.astype('datetime64[ns]').view('i8')
+    open_ns[session_days[inside]] = (session_open % NS_PER_DAY)[inside]
+    close_ns[session_days[inside]] = (session_close % NS_PER_DAY)[inside]
+    day_index = days - first_day
+    return (ns_of_day >= open_ns[day_index]) & (ns_of_day <= close_ns[day_index])
+
+
+def segment_order(symbols, timestamps=None):
+    '''
+    (order, starts): one stable sort of the rows by symbol, row order inside a symbol kept as in groupby('symbol'),
+    or with timestamps ascending in time inside a symbol (get_history frames are newest first).
+    Sorted values x[order] hold every symbol in one segment, starts are the first positions of the segments.
+    '''
+    codes = pd.factorize(symbols)[0]
+    order = np.argsort(codes, kind='stable') if timestamps is None else np.lexsort((np.asarray(timestamps), codes))
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_codes[1:] != sorted_codes[:-1]))) if len(codes) else np.zeros(0, dtype=np.int64)
+    return order, starts
+
+
+def price_direction(returns):
+    '''+1 increase, -1 decrease, 0 no change or NaN (int64 like the lambda x: 1 if x > 0 else -1 if x < 0 else 0 it replaces)'''
+    returns = np.asarray(returns, dtype=float)
+    return (returns > 0).astype(np.int64) - (returns < 0).astype(np.int64)
+
+
+def _segmented_streak_loop(direction, starts, initial_streak, initial_direction, out):
+    n_segments = len(starts)
+    for segment in range(n_segments):
+        end = starts[segment + 1] if segment + 1 < n_segments else len(direction)
+        streak = initial_streak[segment]
+        last_direction = initial_direction[segment]
+        for i in range(starts[segment], end):
+            value = direction[i]
+            if value == 0: # no change keeps the current streak
+                pass
+            elif value == last_direction:
+                streak += value
+            else: # direction changed: streak restarts
+                streak = value
+                last_direction = value
+            out[i] = streak
+
+
+_segmented_streak_jit = _jit(_segmented_streak_loop)
+
+
+def _segmented_streak_numpy(direction, starts, initial_streak, initial_direction):
+    '''runs of equal signs over the non-zero directions (zeros neither extend nor break a run), zeros repeat the last streak'''
+    segment_ids = _segment_ids(starts, len(direction))
+    nonzero = np.flatnonzero(direction)
+    signs = direction[nonzero]
+    nonzero_segments = segment_ids[nonzero]
+    run_index = np.arange(len(nonzero))
+    new_segment = np.ones(len(nonzero), dtype=bool)
+    new_segment[1:] = nonzero_segments[1:] != nonzero_segments[:-1]
+    new_run = new_segment.copy()
+    new_run[1:] |= signs[1:] != signs[:-1]
+    run_start = np.maximum.accumulate(np.where(new_run, run_index, 0))
+    streak_at_nonzero = signs * (run_index - run_start + 1)
+    # the first run of a segment continues the initial streak if it goes in the initial direction
+    continues = new_segment[run_start] & (signs == initial_direction[nonzero_segments])
+    streak_at_nonzero[continues] += initial_streak[nonzero_segments[continues]]
+
+    last_nonzero = np.cumsum(direction != 0) - 1 # index into nonzero of the latest move up to each row
+    known = last_nonzero >= 0
+    known[known] = nonzero_segments[last_nonzero[known]] == segment_ids[known] # latest move must be in the same symbol
+    streak = initial_streak[segment_ids]
+    streak[known] = streak_at_nonzero[last_nonzero[known]]
+    return streak
+
+
+def segmented_streak(direction, starts, initial_streak=None, initial_direction=None):
+    '''
+    Cumulative up/down streak per segment, same numbers as calculate_cumulative_streaks in MyAlpaca.add_columns had:
+    moves in the same direction add up (+3 = three rises), a change of direction restarts at +-1, no change keeps the streak.
+    direction: int64 from price_direction in segment order, starts: from segment_order.
+    initial_streak/initial_direction (per segment) continue a previous run, e.g. from IndicatorState.
+    '''
+    direction = np.ascontiguousarray(direction, dtype=np.int64)
+    starts = np.ascontiguousarray(starts, dtype=np.int64)
+    initial_streak = np.zeros(len(starts), dtype=np.int64) if initial_streak is None else np.ascontiguousarray(initial_streak, dtype=np.int64)
+    initial_direction = np.zeros(len(starts), dtype=np.int64) if initial_direction is None else np.ascontiguousarray(initial_direction, dtype=np.int64)
+    if _segmented_streak_jit is not None:
+        out = np.zeros(len(direction), dtype=np.int64)
+        _segmented_streak_jit(direction, starts, initial_streak, initial_direction, out)
+        return out
+    return _segmented_streak_numpy(direction, starts, initial_streak, initial_direction)
+
+
+# Segmented kernels: values in segment order (x[order] from segment_order), one output array per call, no per-symbol python.
+# Without numba the pandas groupby cython paths run on the segment ids (same values as the groupby code in add_columns).
+
+def _segment_ids(starts, n):
+    return np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+
+
+def _segmented_ewma_loop(values, starts, com, initial, out):
+    '''
+    pandas ewm(com=com, adjust=False).mean() step by step (ignore_na=False, min_periods=0) to get the same floats.
+    A non-NaN initial value of a segment acts as the mean before its first value (continuing an earlier run).
+    '''
+    alpha = 1.0 / (1.0 + com)
+    old_wt_factor = 1.0 - alpha
+    new_wt = alpha
+    n_segments = len(starts)
+    for segment in range(n_segments):
+        start = starts[segment]
+        end = starts[segment + 1] if segment + 1 < n_segments else len(values)
+        old_wt = 1.0
+        first = start
+        weighted = initial[segment]
+        nobs = 1 if weighted == weighted else 0
+        if nobs == 0:
+            weighted = values[start]
+            nobs = 1 if weighted == weighted else 0
+            out[start] = weighted if nobs >= 1 else np.nan
+            first = start + 1
+        for i in range(first, end):
+            cur = values[i]
+            is_observation = cur == cur
+            if is_observation:
+                nobs += 1
+            if weighted == weighted:
+                old_wt *= old_wt_factor
+                if is_observation:
+                    if weighted != cur:
+                        weighted = old_wt * weighted + new_wt * cur
+                        weighted /= (old_wt + new_wt)
+                    old_wt = 1.0
+            elif is_observation:
+                weighted = cur
+            out[i] = weighted if nobs >= 1 else np.nan
+
+
+def _segmented_cummax_loop(values, starts, initial, out):
+    n_segments = len(starts)
+    for segment in range(n_segments):
+        end = starts[segment + 1] if segment + 1 < n_segments else len(values)
+        running = initial[segment] # NaN: no earlier max
+        for i in range(starts[segment], end):
+            value = values[i]
+            if value != value: # NaN stays NaN and does not reset the max (skipna)
+                out[i] = np.nan
+                continue
+            if not running >= value:
+                running = value
+            out[i] = running
+
+
+def _segmented_rolling_std_loop(values, starts, window, out):
+    '''rolling(window).std() (ddof=1, min_periods=window) with Welford add/remove of the values entering/leaving the window'''
+    n_segments = len(starts)
+    for segment in range(n_segments):
+        start = starts[segment]
+        end = starts[segment + 1] if segment + 1 < n_segments else len(values)
+        nobs = 0
+        mean = 0.0
+        ssqdm = 0.0
+        for i in range(start, end):
+            value = values[i]
+            if value == value:
+                nobs += 1
+                delta = value - mean
+                mean += delta / nobs
+                ssqdm += delta * (value - mean)
+            if i - window >= start:
+                leaving = values[i - window]
+                if leaving == leaving:
+                    nobs -= 1
+                    if nobs == 0:
+                        mean = 0.0
+                        ssqdm = 0.0
+                    else:
+                        delta = leaving - mean
+                        mean -= delta / nobs
+                        ssqdm -= delta * (leaving - mean)
+            if nobs >= window and nobs > 1:
+                out[i] = np.sqrt(ssqdm / (nobs - 1)) if ssqdm > 0 else 0.0
+            else:
+                out[i] = np.nan
+
+
+def _segmented_rolling_mean_loop(values, starts, window, min_periods, out):
+    '''rolling(window, min_periods).mean() with a running sum of the non-NaN values in the window'''
+    n_segments = len(starts)
+    for segment in range(n_segments):
+        start = starts[segment]
+        end = starts[segment + 1] if segment + 1 < n_segments else len(values)
+        nobs = 0
+        total = 0.0
+        for i in range(start, end):
+            value = values[i]
+            if value == value:
+                nobs += 1
+                total += value
+            if i - window >= start:
+                leaving = values[i - window]
+                if leaving == leaving:
+                    nobs -= 1
+                    total -= leaving
+            out[i] = total / nobs if nobs >= min_periods and nobs > 0 else np.nan
+
+
+_segmented_ewma_jit = _jit(_segmented_ewma_loop)
+_segmented_cummax_jit = _jit(_segmented_cummax_loop)
+_segmented_rolling_std_jit = _jit(_segmented_rolling_std_loop)
+_segmented_rolling_mean_jit = _jit(_segmented_rolling_mean_loop)
+
+
+def _seeded(values, starts, initial):
+    '''values with each non-NaN initial value put in front of its segment: (values, starts, positions of the original values)'''
+    seeded = ~np.isnan(initial)
+    shift = np.cumsum(seeded) # original row j of segment s moves by the seeds up to and including s
+    segment_ids = _segment_ids(starts, len(values))
+    positions = np.arange(len(values)) + shift[segment_ids]
+    new_starts = starts + shift - seeded
+    extended = np.empty(len(values) + seeded.sum())
+    extended[positions] = values
+    extended[new_starts[seeded]] = initial[seeded]
+    return extended, new_starts, positions
+
+
+def segmented_ewma(values, starts, span, initial=None):
+    '''ewm(span=span, adjust=False).mean() per segment; initial (per segment, NaN = none) continues an earlier mean'''
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    initial = np.full(len(starts), np.nan) if initial is None else np.ascontiguousarray(initial, dtype=np.float64)
+    com = (span - 1) / 2.0
+    if _segmented_ewma_jit is not None:
+        out = np.empty(len(values))
+        _segmented_ewma_jit(values, starts, com, initial, out)
+        return out
+    extended, extended_starts, positions = _seeded(values, starts, initial)
+    return pd.Series(extended).groupby(_segment_ids(extended_starts, len(extended))).ewm(com=com, adjust=False).mean().to_numpy()[positions]
+
+
+def segmented_pct_change(values, starts, periods=1):
+    '''
+    pct_change(periods) per segment (negative periods look ahead like pandas), NaN where the other row is in another segment.
+    NaN values are not forward filled first (pandas 3 default; pandas 2 pads them, bars from the API have no NaN closes).
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    segment_ids = _segment_ids(starts, len(values))
+    other = np.arange(len(values)) - periods
+    valid = (other >= 0) & (other < len(values))
+    valid[valid] = segment_ids[other[valid]] == segment_ids[valid]
+    shifted = np.full(len(values), np.nan)
+    shifted[valid] = values[other[valid]]
+    return values / shifted - 1
+
+
+def segmented_cummax(values, starts, initial=None):
+    '''cummax per segment (NaN stays NaN); initial (per segment, NaN = none) is an earlier running max'''
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    initial = np.full(len(starts), np.nan) if initial is None else np.ascontiguousarray(initial, dtype=np.float64)
+    if _segmented_cummax_jit is not None:
+        out = np.empty(len(values))
+        _segmented_cummax_jit(values, starts, initial, out)
+        return out
+    extended, extended_starts, positions = _seeded(values, starts, initial)
+    return pd.Series(extended).groupby(_segment_ids(extended_starts, len(extended))).cummax().to_numpy()[positions]
+
+
+def segmented_rolling_std(values, starts, window):
+    '''rolling(window).std() per segment; the numba kernel matches pandas up to float rounding (~1e-15 relative)'''
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    if _segmented_rolling_std_jit is not None:
+        out = np.empty(len(values))
+        _segmented_rolling_std_jit(values, np.asarray(starts, dtype=np.int64), int(window), out)
+        return out
+    return pd.Series(values).groupby(_segment_ids(starts, len(values))).rolling(window).std().to_numpy()
+
+
+def segmented_rolling_mean(values, starts, window, min_periods=None):
+    '''rolling(window, min_periods).mean() per segment (min_periods defaults to window like pandas)'''
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    min_periods = window if min_periods is None else min_periods
+    if _segmented_rolling_mean_jit is not None:
+        out = np.empty(len(values))
+        _segmented_rolling_mean_jit(values, np.asarray(starts, dtype=np.int64), int(window), int(min_periods), out)
+        return out
+    return pd.Series(values).groupby(_segment_ids(starts, len(values))).rolling(window, min_periods=min_periods).mean().to_numpy()
+
+
+def true_range(high, low, close, starts):
+    '''max(high, prior close) - min(low, prior close) per segment in time order; the first bar of a segment has no prior close (high - low)'''
+    prior_close = np.empty(len(close))
+    prior_close[1:] = close[:-1]
+    prior_close[starts] = np.nan # no prior close across symbol boundaries
+    return np.fmax(high, prior_close) - np.fmin(low, prior_close)
+
+
+def average_true_range(high, low, close, starts, period=14, wilder=False):
+    '''
+    ATR per segment in time order: rolling mean of the true range over period bars (min_periods=1),
+    or with wilder=True Wilder's smoothing ATR = ATR_prev + (TR - ATR_prev) / period (an EWMA with alpha 1/period)
+    '''
+    tr = true_range(np.asarray(high, dtype=float), np.asarray(low, dtype=float), np.asarray(close, dtype=float), starts)
+    if wilder:
+        return segmented_ewma(tr, starts, span=2 * period - 1) # span 2n-1 <=> alpha 1/n
+    return segmented_rolling_mean(tr, starts, period, min_periods=1)
+
+
+# ---- add_columns features, defined once: indicator_columns evaluates them, indicator_registry registers them as indicators
+# name -> (inputs, windows, func(starts, *inputs, **windows)), every feature after its inputs
+
+def _logret(starts, close):
+    return np.log1p(segmented_pct_change(close, starts, 1))
+
+
+def _running_max(starts, close):
+    return segmented_cummax(close, starts)
+
+
+def _ema(starts, close, span):
+    return segmented_ewma(close, starts, span)
+
+
+def _ret1w(starts, close, weekperiod):
+    return segmented_pct_change(close, starts, weekperiod)
+
+
+def _drawdown(starts, close, running_max):
+    return (close - running_max) / running_max
+
+
+def _volat(starts, logret, span):
+    return segmented_rolling_std(logret, starts, span)
+
+
+def _streak(starts, logret):
+    return segmented_streak(price_direction(logret), starts)
+
+
+INDICATOR_FEATURES = {
+    'logret': (('close',), (), _logret),
+    'running_max': (('close',), (), _running_max),
+    'ema': (('close',), ('span',), _ema),
+    'ret1w': (('close',), ('weekperiod',), _ret1w),
+    'drawdown': (('close', 'running_max'), (), _drawdown),
+    'volat': (('logret',), ('span',), _volat),
+    'streak': (('logret',), (), _streak),
+}
+
+
+def indicator_columns(close, starts, span, weekperiod):
+    '''
+    All add_columns features from close prices in segment order, as float64 arrays (streak int64):
+    ema, ret1w, logret, drawdown, volat, streak.
+    '''
+    values = {'close': np.ascontiguousarray(close, dtype=np.float64)}
+    windows = {'span': span, 'weekperiod': weekperiod}
+    for name, (inputs, window_names, func) in INDICATOR_FEATURES.items():
+        values[name] = func(starts, *[values[column] for column in inputs], **{window: windows[window] for window in window_names})
+    return {column: values[column] for column in INDICATOR_DTYPES}
+
+
+def feature_windows(timestamps, bars_per_symbol):
+    '''(span, weekperiod) of the add_columns features from the interval of the first two timestamps (time order) and the bars per symbol'''
+    interval = (timestamps[1] - timestamps[0]) / np.timedelta64(1, 'm')
+    intervals_per_day = 1 if interval == 1440 else (6.5 * 60) / interval # Number of intervals per day = Trading hours in a day / interval in hours
+    intervals_num = int(np.median(bars_per_symbol)) # there could be symbols with small history: we take the most often length (median)
+    dayz = intervals_num//intervals_per_day
+    span = int(min(dayz//2, 3) * intervals_per_day)
+    weekperiod = int(min(intervals_num,5 * intervals_per_day))
+    return span, weekperiod
+
+
+INDICATOR_DTYPES = {'ema': np.float64, 'ret1w': np.float64, 'logret': np.float64, 'drawdown': np.float64, 'volat': np.float64, 'streak': np.int64}
+
+
+def _shared_array(shm, shape, dtype):
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _indicator_shard(close_name, output_names, n_rows, row_start, row_end, shard_starts, span, weekperiod):
+    '''worker: features of the segments in rows [row_start, row_end), read from and written to shared memory'''
+    blocks = [shared_memory.SharedMemory(name=name) for name in [close_name] + list(output_names.values())]
+    try:
+        close = _shared_array(blocks[0], (n_rows,), np.float64)
+        features = indicator_columns(close[row_start:row_end], shard_starts - row_start, span, weekperiod)
+        for block, (column, dtype) in zip(blocks[1:], INDICATOR_DTYPES.items()):
+            _shared_array(block, (n_rows,), dtype)[row_start:row_end] = features[column]
+        del close, features
+    finally:
+        for block in blocks:
+            block.close()
+
+
+_pool = None # (workers, ProcessPoolExecutor) shared by all parallel_indicator_columns calls
+_pool_lock = threading.Lock()
+
+
+def _process_pool(workers):
+    '''
+    one process pool reused across calls (recreated if another size is asked for). Workers are started by a forkserver (spawn where
+    there is none): forking the caller would copy a process that already runs download threads and the async loop thread,
+    with whatever locks they hold at that moment.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool[0] != workers:
+            if _pool is not None:
+                _pool[1].shutdown(wait=True)
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = (workers, concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)))
+        return _pool[1]
+
+
+@atexit.register
+def _shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool[1].shutdown(wait=True)
+            _pool = None
+
+
+def parallel_indicator_columns(close, starts, span, weekperiod, workers=None):
+    '''
+    indicator_columns with the segments (symbols) sharded over a process pool, shards balanced by rows.
+    close and the output columns live in shared memory: only names and row offsets are pickled, no frames or arrays.
+    workers=1 (or a single symbol) runs in-process. Workers do not fork the caller (see _process_pool), so a script
+    using workers > 1 needs the usual if __name__ == '__main__': guard.
+    '''
+    workers = workers or os.cpu_count()
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    n_rows = len(close)
+    if workers <= 1 or len(starts) < 2:
+        return indicator_columns(close, starts, span, weekperiod)
+
+    # shard boundaries at the segment starts closest to equal row counts
+    boundaries = np.unique(np.searchsorted(starts, np.arange(1, workers) * n_rows / workers))
+    boundaries = boundaries[(boundaries > 0) & (boundaries < len(starts))]
+    segment_groups = np.split(np.arange(len(starts)), boundaries)
+
+    blocks = {'close': shared_memory.SharedMemory(create=True, size=max(1, close.nbytes))}
+    for column, dtype in INDICATOR_DTYPES.items():
+        blocks[column] = shared_memory.SharedMemory(create=True, size=max(1, n_rows * np.dtype(dtype).itemsize))
+    try:
+        _shared_array(blocks['close'], (n_rows,), np.float64)[:] = close
+        output_names = {column: blocks[column].name for column in INDICATOR_DTYPES}
+        executor = _process_pool(workers)
+        futures = [executor.submit(_indicator_shard, blocks['close'].name, output_names, n_rows,
+                                   starts[group[0]], starts[group[-1] + 1] if group[-1] + 1 < len(starts) else n_rows,
+                                   starts[group], span, weekperiod)
+                   for group in segment_groups]
+        for future in futures:
+            future.result() # re-raises worker errors
+        return {column: _shared_array(blocks[column], (n_rows,), dtype).copy() for column, dtype in INDICATOR_DTYPES.items()}
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+
+def indicator_segments(df):
+    '''(order, starts, span, weekperiod) of a bar frame: rows by symbol and time (segment_order), windows from feature_windows'''
+    timestamps = df['timestamp'].to_numpy()
+    order, starts = segment_order(df['symbol'].to_numpy(), timestamps)
+    bars_per_symbol = np.add.reduceat(~np.isnan(df['close'].to_numpy(dtype=float)[order]), starts)
+    return (order, starts) + feature_windows(timestamps[order[:2]], bars_per_symbol)
+
+
+def add_indicator_columns(df, workers=1):
+    '''
+    MyAlpaca.add_columns without a state: ema, ret1w, logret, drawdown, volat, streak as columns of df (rows in any order).
+    Every symbol is computed in time order (one sort by symbol and timestamp), the columns go back to the row order of df.
+    '''
+    order, starts, span, weekperiod = indicator_segments(df)
+    close = df['close'].to_numpy(dtype=float)[order]
+    for column, values in parallel_indicator_columns(close, starts, span, weekperiod, workers).items():
+        column_values = np.empty_like(values)
+        column_values[order] = values
+        df[column] = column_values
+    return df
+
+
+COMPACT_DTYPES = {'open': np.float32, 'high': np.float32, 'low': np.float32, 'close': np.float32, 'vwap': np.float32,
+                  'volume': np.uint32, 'trade_count': np.uint32}
+
+
+def compact_bars(df, symbols=None):
+    '''
+    Bar frame with compact dtypes (get_history(compact=True)): categorical symbol, float32 prices, uint32 volume/trade_count,
+    timestamp as int64 ns (datetime64[ns]). About a third of the memory of object strings and float64.
+    symbols fixes the categories, so chunks concatenated later keep the categorical dtype (instead of falling back to object).
+    float32 keeps ~7 significant digits: e.g. 1234.5678 comes back as 1234.5677 (see indicator_registry.compact_drift).
+    Counts that are not whole numbers in the uint32 range (NaN, fractional) keep their dtype.
+    '''
+    columns = {}
+    if 'symbol' in df.columns:
+        categories = sorted(set(symbols)) if symbols is not None else None
+        columns['symbol'] = pd.Categorical(df['symbol'], categories=categories)
+    if 'timestamp' in df.columns:
+        timestamp = df['timestamp']
+        columns['timestamp'] = timestamp.dt.as_unit('ns') if timestamp.dtype.kind == 'M' else timestamp
+    for column, dtype in COMPACT_DTYPES.items():
+        if column not in df.columns:
+            continue
+        values = df[column].to_numpy()
+        if np.dtype(dtype).kind == 'u':
+            if values.size and not (np.isfinite(values).all() and values.min() >= 0 and values.max() <= np.iinfo(dtype).max
+                                    and (values == np.floor(values)).all()):
+                continue
+        columns[column] = values.astype(dtype)
+    # a new frame instead of assign: assign copies (and consolidates) the whole float64 frame first
+    return pd.DataFrame({column: columns.get(column, df[column]) for column in df.columns}, index=df.index, copy=False)
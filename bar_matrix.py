@@ -0,0 +1,105 @@
+'''
+Dense symbol x time representation of bar data: one float32 2-D array per field (rows = symbols, columns = a shared
+timestamp axis), NaN where a symbol has no bar. Indicators can run column-wise over all symbols at once instead of groupby('symbol').
+    matrix = BarMatrix.from_frame(alpaca_instance.get_history(symbols, periods=570))
+    returns = matrix.pct_change('close')              # (n_symbols, n_times)
+    print(matrix.memory_report(long_df))
+float32 keeps ~7 significant digits: enough for prices, volumes above 16.7M get rounded (use the frame for exact volumes).
+'''
+import numpy as np
+import pandas as pd
+
+
+FIELDS = ('open', 'high', 'low', 'close', 'volume', 'trade_count')
+
+
+class BarMatrix:
+
+    def __init__(self, symbols, timestamps, data):
+        self.symbols = np.asarray(symbols, dtype=object)
+        self.timestamps = pd.DatetimeIndex(timestamps)
+        self.data = {field: np.asarray(values, dtype=np.float32) for field, values in data.items()}
+        self.symbol_index = {symbol: row for row, symbol in enumerate(self.symbols)}
+        for field, values in self.data.items():
+            if values.shape != self.shape:
+                raise ValueError(f'{field} has shape {values.shape}, expected {self.shape}')
+
+
+    @classmethod
+    def from_frame(cls, df, fields=FIELDS, time_column='timestamp'):
+        '''long frame (symbol, timestamp, fields; any row order) => matrix with symbols and timestamps ascending'''
+        fields = [field for field in fields if field in df.columns]
+        rows, symbols = pd.factorize(df['symbol'], sort=True)
+        columns, timestamps = pd.factorize(df[time_column], sort=True)
+        data = {}
+        for field in fields:
+            values = np.full((len(symbols), len(timestamps)), np.nan, dtype=np.float32)
+            values[rows, columns] = df[field].to_numpy(dtype=np.float32) # duplicated bars: the last row wins
+            data[field] = values
+        return cls(symbols, timestamps, data)
+
+
+    def to_frame(self, dropna=True):
+        '''back to the long frame (symbol, timestamp, fields as float64), symbols then time ascending; without dropna missing bars stay as NaN rows'''
+        rows, columns = np.divmod(np.arange(self.shape[0] * self.shape[1]), self.shape[1])
+        if dropna and 'close' in self.data:
+            present = ~np.isnan(self.data['close'].ravel())
+            rows, columns = rows[present], columns[present]
+        df = pd.DataFrame({'symbol': self.symbols[rows], 'timestamp': self.timestamps[columns]})
+        for field, values in self.data.items():
+            df[field] = values[rows, columns].astype(np.float64)
+        return df
+
+
+    @property
+    def shape(self):
+        return len(self.symbols), len(self.timestamps)
+
+
+    def __getitem__(self, field):
+        return self.data[field]
+
+
+    def row(self, symbol, field='close'):
+        '''bars of one symbol as a Series on the timestamp axis'''
+        return pd.Series(self.data[field][self.symbol_index[symbol]], index=self.timestamps, name=symbol)
+
+
+    def select(self, symbols):
+        rows = [self.symbol_index[symbol] for symbol in symbols]
+        return BarMatrix(self.symbols[rows], self.timestamps, {field: values[rows] for field, values in self.data.items()})
+
+
+    def pct_change(self, field='close', periods=1):
+        '''change against the bar periods columns earlier (NaN if either bar is missing), all symbols at once'''
+        values = self.data[field]
+        shifted = np.full_like(values, np.nan)
+        n_times = values.shape[1] # periods beyond the time axis leave shifted all NaN
+        if 0 <= periods < n_times:
+            shifted[:, periods:] = values[:, :n_times - periods]
+        elif -n_times < periods < 0:
+            shifted[:, :periods] = values[:, -periods:]
+        return values / shifted - 1
+
+
+    def last_valid(self, field='close'):
+        '''latest non-NaN value per symbol (NaN if a symbol has no bar at all)'''
+        values = self.data[field]
+        present = ~np.isnan(values)
+        last_column = values.shape[1] - 1 - np.argmax(present[:, ::-1], axis=1)
+        return np.where(present.any(axis=1), values[np.arange(len(values)), last_column], np.nan)
+
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.data.values()) + self.timestamps.nbytes + self.symbols.nbytes
+
+
+    def memory_report(self, df=None):
+        '''bytes of the matrix and, if given, of the equivalent long DataFrame (deep, i.e. with the symbol strings)'''
+        report = {'shape': self.shape, 'fill_ratio': float((~np.isnan(next(iter(self.data.values())))).mean()) if self.data else 0.0,
+                  'matrix_bytes': self.nbytes}
+        if df is not None:
+            report['frame_bytes'] = int(df.memory_usage(deep=True).sum())
+            report['ratio'] = report['frame_bytes'] / max(1, report['matrix_bytes'])
+        return report
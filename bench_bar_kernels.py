@@ -0,0 +1,436 @@
+'''
+Timing of the vectorized kernels in bar_kernels.py (and the bar_matrix.py container) against the pandas code they replace in utils_for_alpaca.py.
+    python bench_bar_kernels.py            # all benchmarks
+    python bench_bar_kernels.py last_n     # one benchmark
+'''
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import bar_kernels
+import bar_matrix
+import indicator_registry
+import quote_spreads
+import streaming_indicators
+import volume_profile
+
+
+def synthetic_bars(n_symbols, n_bars, freq='5min', seed=0, columns=('open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap'), shuffle_rows=False):
+    '''
+    long frame like raw get_history downloads: one block per symbol with ascending timestamps, blocks in random (chunk arrival) order.
+    shuffle_rows=True gives the worst case of fully unordered rows. Fewer columns keep big runs in RAM.
+    '''
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range('2024-01-02 09:30', periods=n_bars, freq=freq)
+    symbols = np.array([f'S{i:04d}' for i in range(n_symbols)], dtype=object)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.002, (n_symbols, n_bars)), axis=1))
+    if shuffle_rows:
+        order = rng.permutation(n_symbols * n_bars)
+    else:
+        order = (rng.permutation(n_symbols)[:, None] * n_bars + np.arange(n_bars)).ravel()
+    close = close.ravel()[order]
+    df = pd.DataFrame({'symbol': np.repeat(symbols, n_bars)[order], 'timestamp': np.tile(timestamps.values, n_symbols)[order]})
+    for column in columns:
+        if column == 'close':
+            df[column] = close
+        elif column in ('open', 'vwap'):
+            df[column] = close * (1 + rng.normal(0, 0.0005, len(order)))
+        elif column == 'high':
+            df[column] = close * (1 + np.abs(rng.normal(0, 0.001, len(order))))
+        elif column == 'low':
+            df[column] = close * (1 - np.abs(rng.normal(0, 0.001, len(order))))
+        else:
+            df[column] = rng.integers(1, 100000, len(order)).astype(float)
+    return df
+
+
+def timed(label, func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    print(f'{label:<45} {time.perf_counter() - started:8.3f}s')
+    return result
+
+
+def bench_last_n(n_symbols=2500, n_bars=10000, periods=570):
+    for shuffle_rows in (False, True):
+        print(f'last {periods} bars per symbol on {n_symbols} x {n_bars} rows ({"shuffled rows" if shuffle_rows else "API layout"})')
+        df = synthetic_bars(n_symbols, n_bars, columns=('close', 'volume'), shuffle_rows=shuffle_rows)
+        old = timed('groupby.apply(nlargest)', lambda: df.groupby('symbol', group_keys=False).apply(lambda x: x.nlargest(periods, 'timestamp')))
+        new = timed('bar_kernels.last_n_per_symbol', bar_kernels.last_n_per_symbol, df, periods)
+        print('identical output:', old.reset_index(drop=True).equals(new.reset_index(drop=True)))
+        del df, old, new
+
+
+def bench_session_filter(n_symbols=5000, n_bars=10000):
+    '''default is 50M one-minute bars; the old path builds one python time object per row, pass smaller sizes on small machines'''
+    print(f'UTC -> ET and 09:30-16:00 filter on {n_symbols} x {n_bars} one-minute bars')
+    df = synthetic_bars(n_symbols, n_bars, freq='1min', columns=())
+    df['timestamp'] = df['timestamp'].dt.tz_localize('UTC')
+    def old_filter():
+        local = df['timestamp'].dt.tz_convert('America/New_York').dt.tz_localize(None)
+        return local, local.dt.time.between(pd.to_datetime('09:30:00').time(), pd.to_datetime('16:00:00').time()).to_numpy()
+    def new_filter():
+        local = bar_kernels.to_ny_local(df['timestamp'])
+        return local, bar_kernels.regular_session_mask(local)
+    old_local, old_mask = timed('tz_convert + dt.time.between', old_filter)
+    new_local, new_mask = timed('bar_kernels.to_ny_local + session mask', new_filter)
+    print('identical output:', bool((old_local.to_numpy() == new_local).all() and (old_mask == new_mask).all()))
+
+
+def calculate_cumulative_streaks(series):
+    '''the per-symbol loop add_columns used before bar_kernels.segmented_streak'''
+    streak = 0
+    last_direction = 0
+    streaks = []
+    for value in series:
+        if value == 0:
+            streaks.append(streak)
+        elif value == last_direction:
+            streak += value
+            streaks.append(streak)
+        else:
+            streak = value
+            streaks.append(streak)
+            last_direction = value
+    return streaks
+
+
+def bench_streak(n_symbols=2500, n_bars=570):
+    print(f'direction + cumulative streak on {n_symbols} x {n_bars} rows (numba {"on" if bar_kernels.numba is not None else "not installed"})')
+    df = synthetic_bars(n_symbols, n_bars, columns=('close',), shuffle_rows=True)
+    df.loc[df.sample(frac=0.1, random_state=0).index, 'close'] = np.round(df['close'], 0) # some unchanged prices
+    df['logret'] = df.groupby('symbol')['close'].pct_change().apply(np.log1p)
+
+    def old_streak():
+        direction = df['logret'].apply(lambda x: 1 if x > 0 else -1 if x < 0 else 0)
+        return direction.groupby(df['symbol']).transform(calculate_cumulative_streaks).to_numpy()
+
+    def new_streak(segmented_streak):
+        order, starts = bar_kernels.segment_order(df['symbol'].to_numpy())
+        streak = np.empty(len(df), dtype=np.int64)
+        no_history = np.zeros(len(starts), dtype=np.int64) # fresh run, nothing to continue
+        streak[order] = segmented_streak(bar_kernels.price_direction(df['logret'].to_numpy())[order], starts, no_history, no_history)
+        return streak
+
+    old = timed('apply(lambda) + transform(python loop)', old_streak)
+    bar_kernels.segmented_streak(*[np.zeros(1, dtype=np.int64)] * 4) # numba compile (cached on disk after the first run)
+    new = timed('bar_kernels.segmented_streak', new_streak, bar_kernels.segmented_streak)
+    numpy_only = timed('bar_kernels._segmented_streak_numpy', new_streak, bar_kernels._segmented_streak_numpy)
+    print('identical output:', old.dtype == new.dtype and np.array_equal(old, new) and np.array_equal(old, numpy_only))
+
+
+def add_columns_reference(df):
+    '''MyAlpaca.add_columns before the segmented engine (six groupby passes, streak loop from user code)'''
+    interval = (df['timestamp'].iloc[1] - df['timestamp'].iloc[0]).total_seconds() / 60
+    intervals_per_day = 1 if interval == 1440 else (6.5 * 60) / interval
+    intervals_num = int(df.groupby('symbol')['close'].count().median())
+    dayz = intervals_num//intervals_per_day
+    span = int(min(dayz//2, 3) * intervals_per_day)
+    weekperiod = int(min(intervals_num,5 * intervals_per_day))
+    df['ema'] = df.groupby('symbol')['close'].transform(lambda x: x.ewm(span=span, adjust=False).mean())
+    df['ret1w'] = df.groupby("symbol")["close"].pct_change(weekperiod)
+    df['logret'] = df.groupby('symbol')['close'].pct_change().apply(np.log1p)
+    df['drawdown'] = df.groupby('symbol')['close'].transform(lambda prices: (prices - prices.cummax()) / prices.cummax())
+    df['volat'] = df.groupby('symbol')['logret'].transform(lambda x: x.rolling(window=span).std())
+    df['direction'] = df['logret'].apply(lambda x: 1 if x > 0 else -1 if x < 0 else 0)
+    df['streak'] = df.groupby('symbol')['direction'].transform(calculate_cumulative_streaks)
+    df.drop(columns=['direction'], inplace=True)
+    return df
+
+
+def compare_columns(old, new, columns=('ema', 'ret1w', 'logret', 'drawdown', 'volat', 'streak')):
+    for column in columns:
+        a, b = old[column].to_numpy(), new[column].to_numpy()
+        same_nan = np.array_equal(np.isnan(a.astype(float)), np.isnan(b.astype(float)))
+        max_diff = np.nanmax(np.abs(a - b)) if same_nan and (~np.isnan(a.astype(float))).any() else float('nan')
+        print(f'  {column:<9} identical: {str(np.array_equal(a, b, equal_nan=True) and a.dtype == b.dtype):<6} NaN pattern equal: {same_nan}  max abs diff: {max_diff:.2e}')
+
+
+def bench_add_columns(n_symbols=2500, n_bars=570):
+    '''
+    get_history layout: symbols ascending, newest bar first. MyAlpaca.add_columns without a state is bar_kernels.add_indicator_columns;
+    the reference gets the rows in time order (as the features are meant) and is compared row by row.
+    '''
+    print(f'add_columns on {n_symbols} x {n_bars} 15min bars (numba {"on" if bar_kernels.numba is not None else "not installed"})')
+    df = synthetic_bars(n_symbols, n_bars, freq='15min', columns=('close',))
+    df = df.sort_values(['symbol', 'timestamp'], ascending=[True, False], ignore_index=True)
+    old = timed('groupby passes (reference)', lambda: add_columns_reference(df.sort_values(['symbol', 'timestamp'])).loc[df.index])
+    bar_kernels.add_indicator_columns(df.head(2 * n_bars).copy()) # numba compile (cached on disk after the first run)
+    new = timed('bar_kernels.add_indicator_columns', bar_kernels.add_indicator_columns, df.copy())
+    compare_columns(old, new)
+    if bar_kernels.numba is not None:
+        jitted = {name: getattr(bar_kernels, name) for name in dir(bar_kernels) if name.endswith('_jit')}
+        for name in jitted:
+            setattr(bar_kernels, name, None)
+        try:
+            fallback = timed('add_indicator_columns without numba', bar_kernels.add_indicator_columns, df.copy())
+            compare_columns(old, fallback)
+        finally:
+            for name, func in jitted.items():
+                setattr(bar_kernels, name, func)
+
+
+def bench_atr(n_symbols=10000, n_bars=42, period=14):
+    '''whole-universe daily ATR as get_atr_stoploss needs it (3 x 14 daily bars); the old apply gets the rows oldest first'''
+    print(f'ATR({period}) on {n_symbols} x {n_bars} daily bars')
+    df = synthetic_bars(n_symbols, n_bars, freq='1D', columns=('high', 'low', 'close'))
+    df = df.sort_values(['symbol', 'timestamp'], ignore_index=True)
+
+    def calculate_tr_and_atr(group, period=period):
+        group['Prior Close'] = group['close'].shift()
+        group['TR'] = group[['high', 'Prior Close']].max(axis=1) - group[['low', 'Prior Close']].min(axis=1)
+        group['ATR'] = group['TR'].rolling(window=period, min_periods=1).mean()
+        return group
+
+    def old_atr():
+        prices_df = df.groupby('symbol').apply(calculate_tr_and_atr).reset_index(drop=True)
+        return prices_df.groupby('symbol').last()['ATR'].to_dict()
+
+    def new_atr(wilder=False):
+        codes, symbols = pd.factorize(df['symbol'])
+        order = np.lexsort((df['timestamp'].to_numpy(), codes))
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_codes[1:] != sorted_codes[:-1])))
+        atr = bar_kernels.average_true_range(df['high'].to_numpy()[order], df['low'].to_numpy()[order], df['close'].to_numpy()[order],
+                                             starts, period=period, wilder=wilder)
+        ends = np.append(starts[1:], len(order)) - 1
+        return dict(zip(symbols[sorted_codes[ends]], atr[ends].tolist()))
+
+    old = timed('groupby.apply(calculate_tr_and_atr)', old_atr)
+    new_atr(), new_atr(True) # numba compile (cached on disk after the first run)
+    new = timed('bar_kernels.average_true_range', new_atr)
+    print('max abs diff:', max(abs(old[symbol] - new[symbol]) for symbol in old), 'same symbols:', old.keys() == new.keys())
+    wilder = timed('bar_kernels.average_true_range(wilder)', new_atr, True)
+    prior_close = df.groupby('symbol')['close'].shift()
+    tr = np.fmax(df['high'], prior_close) - np.fmin(df['low'], prior_close)
+    expected = tr.groupby(df['symbol']).apply(lambda x: x.ewm(alpha=1 / period, adjust=False).mean().iloc[-1]).to_dict()
+    print('wilder max abs diff vs ewm(alpha=1/n):', max(abs(expected[symbol] - wilder[symbol]) for symbol in expected))
+
+
+def bench_bar_matrix(n_symbols=2500, n_bars=570):
+    print(f'BarMatrix for {n_symbols} x {n_bars} 15min bars (5% missing)')
+    df = synthetic_bars(n_symbols, n_bars, freq='15min', columns=bar_matrix.FIELDS).sample(frac=0.95, random_state=0)
+    matrix = timed('BarMatrix.from_frame', bar_matrix.BarMatrix.from_frame, df)
+    back = timed('BarMatrix.to_frame', matrix.to_frame)
+    print('memory:', matrix.memory_report(df))
+    old = timed('groupby pct_change(26) on the frame', lambda: df.sort_values(['symbol', 'timestamp']).groupby('symbol')['close'].pct_change(26))
+    new = timed('BarMatrix.pct_change(26)', matrix.pct_change, 'close', 26)
+    expected = df.sort_values(['symbol', 'timestamp'])
+    print('round trip equal (float32):', np.allclose(back[list(bar_matrix.FIELDS)].to_numpy(), expected[list(bar_matrix.FIELDS)].to_numpy(), rtol=1e-6),
+          (back['symbol'].to_numpy() == expected['symbol'].to_numpy()).all())
+    del old, new
+
+
+def bench_streaming(n_history=1000, n_minutes=500, seconds_per_minute=10):
+    '''
+    ws_Mom_Buy_till_10 pattern: every second bar updates the forming minute and the MACD line is needed again.
+    Old: ewm over the whole close history per message (what ta.macd does), new: streaming MACD(adjust=True) with replace.
+    '''
+    print(f'MACD(12, 26) line on {n_minutes} minutes x {seconds_per_minute} second bars after {n_history} history minutes')
+    rng = np.random.default_rng(0)
+    closes = list(100 * np.exp(np.cumsum(rng.normal(0, 0.0005, n_history))))
+    ticks = [(minute, closes[-1] * np.exp(rng.normal(0, 0.002))) for minute in range(n_minutes) for _ in range(seconds_per_minute)]
+
+    def old_stream():
+        history = list(closes)
+        current_minute, last = None, None
+        for minute, price in ticks:
+            if minute == current_minute:
+                history[-1] = price
+            else:
+                history.append(price)
+                current_minute = minute
+            series = pd.Series(history)
+            last = (series.ewm(span=12, min_periods=12).mean() - series.ewm(span=26, min_periods=26).mean()).iloc[-3:].tolist()
+        return last, history
+
+    def new_stream():
+        line = streaming_indicators.MACD(12, 26, keep=3, output='macd', adjust=True)
+        line.seed(closes)
+        current_minute = None
+        for minute, price in ticks:
+            line.update(price, replace=minute == current_minute)
+            current_minute = minute
+        return list(line.values)
+
+    old, history = timed('ewm over the whole history per message', old_stream)
+    new = timed('streaming_indicators.MACD.update', new_stream)
+    print('same last values:', np.allclose(old, new, rtol=1e-12), f'({len(history)} minutes at the end)')
+
+
+def bench_parallel(n_symbols=2500, n_bars=9828, max_workers=None):
+    '''add_columns features on 6 months of 5min bars (126 sessions x 78) for 1..max_workers processes (default: all cores)'''
+    max_workers = max_workers or os.cpu_count()
+    print(f'indicator columns on {n_symbols} x {n_bars} 5min bars, 1..{max_workers} workers ({os.cpu_count()} cores)')
+    df = synthetic_bars(n_symbols, n_bars, freq='5min', columns=('close',))
+    order, starts = bar_kernels.segment_order(df['symbol'].to_numpy())
+    close = df['close'].to_numpy()[order]
+    del df
+    bar_kernels.indicator_columns(close[:2 * n_bars], starts[:2], 78, 390) # numba compile (cached on disk after the first run)
+    serial = timed('1 worker (in-process)', bar_kernels.parallel_indicator_columns, close, starts, 78, 390, 1)
+    workers = 2
+    while workers <= max(2, max_workers):
+        bar_kernels.parallel_indicator_columns(close[:2 * n_bars], starts[:2], 78, 390, workers) # starts the reused pool of this size
+        sharded = timed(f'{workers} workers', bar_kernels.parallel_indicator_columns, close, starts, 78, 390, workers)
+        print('  identical output:', all(np.array_equal(serial[column], sharded[column], equal_nan=True) for column in serial))
+        workers *= 2
+
+
+def update_database_chunk(df, compact):
+    '''update_database workload of one iter_history chunk: (compact dtypes,) market hours, last periods bars, mean volume per time of day'''
+    if compact:
+        df = bar_kernels.compact_bars(df, df['symbol'].unique())
+    df = df.assign(timestamp=bar_kernels.to_ny_local(df['timestamp']))
+    df = df[bar_kernels.regular_session_mask(df['timestamp'].values)]
+    df = bar_kernels.last_n_per_symbol(df, 14 * 22 * 6).reset_index(drop=True)
+    memory = df.memory_usage(deep=True).sum()
+    df['time_period'] = df['timestamp'].dt.time
+    averages = df.groupby(['symbol', 'time_period'], observed=True).agg({'volume': 'mean', 'trade_count': 'mean'}).reset_index()
+    averages['symbol'] = averages['symbol'].astype(str)
+    return averages, memory
+
+
+def bench_compact(n_symbols=500, n_bars=20000):
+    print(f'update_database workload for a chunk of {n_symbols} symbols x {n_bars} 5min bars (UTC, all hours)')
+    df = synthetic_bars(n_symbols, n_bars)
+    df['timestamp'] = (df['timestamp'] + pd.Timedelta(hours=5)).dt.tz_localize('UTC') # ~ET => UTC
+    print(f'  raw frame {df.memory_usage(deep=True).sum() / 2**20:.0f} MB, compact {bar_kernels.compact_bars(df).memory_usage(deep=True).sum() / 2**20:.0f} MB')
+    full, full_memory = timed('float64 / object symbols', update_database_chunk, df, False)
+    compact, compact_memory = timed('compact dtypes', update_database_chunk, df, True)
+    print(f'  cleaned frame {full_memory / 2**20:.0f} MB -> {compact_memory / 2**20:.0f} MB ({full_memory / compact_memory:.1f}x)')
+    print('  same averages:', full[['symbol', 'time_period']].equals(compact[['symbol', 'time_period']]),
+          np.array_equal(full[['volume', 'trade_count']].to_numpy(), compact[['volume', 'trade_count']].to_numpy()))
+    print('indicator drift of float32 prices (570 15min bars per symbol):')
+    print(indicator_registry.compact_drift(synthetic_bars(n_symbols, 570, freq='15min'), span=78).to_string())
+
+
+def bench_volume_profile(n_symbols=500, n_days=126):
+    print(f'volume profile of {n_symbols} symbols x {n_days} days of 5min bars')
+    timestamps = (pd.date_range('2024-01-02', periods=n_days, freq='B').values[:, None] +
+                  pd.timedelta_range('09:30:00', periods=volume_profile.SLOTS, freq='5min').values[None, :]).ravel()
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'symbol': np.repeat(np.array([f'S{i:04d}' for i in range(n_symbols)], dtype=object), len(timestamps)),
+                       'timestamp': np.tile(timestamps, n_symbols),
+                       'volume': rng.integers(1, 100000, n_symbols * len(timestamps)).astype(float),
+                       'trade_count': rng.integers(1, 1000, n_symbols * len(timestamps)).astype(float)})
+    df = df.sample(frac=0.97, random_state=0) # some missing bars
+
+    def groupby_profile(df):
+        df = df.assign(time_period=df['timestamp'].dt.time)
+        return df.groupby(['symbol', 'time_period']).agg({'volume': ['mean', 'median'], 'trade_count': ['mean', 'median']})
+
+    old = timed('groupby symbol, time of day (mean, median)', groupby_profile, df)
+    profile = timed('VolumeProfile.from_bars', volume_profile.VolumeProfile.from_bars, df)
+    rows = old.index.get_level_values('symbol').map(profile.symbol_index).to_numpy()
+    slots = [volume_profile.slot_of(t) for t in old.index.get_level_values('time_period')]
+    for field, column in (('volume_mean', ('volume', 'mean')), ('volume_median', ('volume', 'median')), ('trade_count_median', ('trade_count', 'median'))):
+        print(f'  {field} equal (float32):', np.allclose(profile.table[field][rows, slots], old[column].to_numpy(), rtol=1e-6))
+
+    path = 'bench_volume_profile.npy'
+    profile.save(path)
+    loaded = timed('VolumeProfile.load (mmap)', volume_profile.VolumeProfile.load, path)
+    symbols = list(loaded.symbol_index)
+    when = pd.Timestamp('2024-06-03 09:35')
+    started = time.perf_counter()
+    for symbol in symbols:
+        loaded.expected(symbol, when)
+    print(f'  expected() {(time.perf_counter() - started) / len(symbols) * 1e6:.1f} us per lookup')
+    timed('expected_many for all symbols', loaded.expected_many, symbols, when)
+    flat = old.reset_index()
+    flat.columns = ['symbol', 'time_period', 'volume', 'volume_median', 'trade_count', 'trade_count_median']
+    timed('same lookup in the groupby frame (one symbol)', lambda: flat.loc[(flat['symbol'] == symbols[0]) & (flat['time_period'] == when.time()), 'volume'].iloc[0])
+    del loaded
+    os.remove(path)
+
+
+def bench_spreads(n_quotes=10000):
+    print(f'spreads of {n_quotes} latest quotes (raw JSON as returned by the data API)')
+    rng = np.random.default_rng(0)
+    ask = np.round(rng.uniform(2, 500, n_quotes), 2)
+    bid = np.round(ask * (1 - rng.uniform(-0.0005, 0.02, n_quotes)), 2) # a few crossed
+    bid[::500] = 0 # no bid
+    raw = {f'S{i:05d}': {'t': '2025-01-02T15:00:00.123456789Z', 'ax': 'V', 'ap': a, 'as': 1, 'bx': 'Q', 'bp': b, 'bs': 2, 'c': ['R'], 'z': 'C'}
+           for i, (a, b) in enumerate(zip(ask.tolist(), bid.tolist()))}
+
+    def loop_spreads(quotes):
+        rows = []
+        for symbol, info in quotes.items():
+            try:
+                spread = (info.ask_price - info.bid_price) / info.ask_price
+                rows.append({'symbol': symbol, 'spread': spread})
+            except:
+                continue
+        return pd.DataFrame(rows)
+
+    try:
+        from alpaca.data.historical.utils import parse_obj_as_symbol_dict # pydantic Quote models, what get_stock_latest_quote builds
+        from alpaca.data.models import Quote
+        quotes = timed('Quote models (SDK parsing)', parse_obj_as_symbol_dict, Quote, raw)
+    except ImportError:
+        import types
+        quotes = {symbol: types.SimpleNamespace(ask_price=quote['ap'], bid_price=quote['bp']) for symbol, quote in raw.items()}
+        print('  (alpaca-py not installed: loop timed on plain objects, without model parsing)')
+    old = timed('loop over quote objects', loop_spreads, quotes)
+    new = timed('quote_spreads.latest_spreads (raw)', quote_spreads.latest_spreads, raw)
+    merged = old.merge(new, on='symbol', suffixes=('_old', '_new'))
+    print(f'  {len(old)} -> {len(new)} rows (zero bids dropped), {int(new.crossed.sum())} crossed,',
+          'same spreads (float32):', np.allclose(merged.spread_old, merged.spread_new, rtol=1e-6),
+          f'memory {old.memory_usage(deep=True).sum() // 1024} -> {new.memory_usage(deep=True).sum() // 1024} KB')
+
+
+def bench_spread_quality(n_symbols=1000, n_quotes=200, minutes=10):
+    print(f'time-weighted median/p90 spread of {n_symbols} symbols x {n_quotes} historical quotes ({minutes} minutes)')
+    rng = np.random.default_rng(0)
+    window_start = pd.Timestamp('2025-01-02 20:50', tz='UTC')
+    window_end = window_start + pd.Timedelta(minutes=minutes)
+    raw = {}
+    for i in range(n_symbols):
+        offsets = np.sort(rng.integers(0, minutes * 60 * 10**9, n_quotes))
+        ask = np.round(rng.uniform(20, 21, n_quotes), 2)
+        bid = np.round(ask - rng.exponential(0.02, n_quotes) - 0.01, 2)
+        raw[f'S{i:04d}'] = [{'t': t.isoformat().replace('+00:00', 'Z'), 'ap': a, 'bp': b}
+                            for t, a, b in zip(window_start + pd.to_timedelta(offsets), ask.tolist(), bid.tolist())]
+
+    def per_symbol_reference(raw):
+        rows = []
+        for symbol, quotes in raw.items():
+            df = pd.DataFrame(quotes)
+            df['t'] = pd.to_datetime(df['t'], format='ISO8601')
+            df['weight'] = (df['t'].shift(-1).fillna(window_end) - df['t']).dt.total_seconds()
+            df['spread'] = (df['ap'] - df['bp']) / df['ap']
+            df = df[(df['bp'] > 0) & (df['ap'] > 0) & (df['bp'] <= df['ap'])].sort_values('spread', kind='stable')
+            share = df['weight'].cumsum() / df['weight'].sum()
+            rows.append({'symbol': symbol, 'spread_median': df['spread'][share >= 0.5].iloc[0], 'spread_p90': df['spread'][share >= 0.9].iloc[0]})
+        return pd.DataFrame(rows)
+
+    old = timed('per symbol frames (pandas)', per_symbol_reference, raw)
+    arrays = timed('quote_history_arrays (parse raw quotes)', quote_spreads.quote_history_arrays, raw, window_end.value)
+    new = timed('time_weighted_spreads (one vectorized pass)', quote_spreads.time_weighted_spreads, [arrays])
+    print('  same quantiles (float32):', np.allclose(old[['spread_median', 'spread_p90']].to_numpy(), new[['spread_median', 'spread_p90']].to_numpy(), rtol=1e-6))
+
+
+BENCHMARKS = {
+    'last_n': bench_last_n,
+    'session_filter': bench_session_filter,
+    'streak': bench_streak,
+    'add_columns': bench_add_columns,
+    'atr': bench_atr,
+    'bar_matrix': bench_bar_matrix,
+    'streaming': bench_streaming,
+    'parallel': bench_parallel,
+    'compact': bench_compact,
+    'volume_profile': bench_volume_profile,
+    'spreads': bench_spreads,
+    'spread_quality': bench_spread_quality,
+}
+
+
+if __name__ == '__main__':
+    # optional sizes after the name, e.g. python bench_bar_kernels.py last_n 500 10000 (smaller machines)
+    names = [a for a in sys.argv[1:] if not a.isdigit()] or list(BENCHMARKS)
+    sizes = [int(a) for a in sys.argv[1:] if a.isdigit()]
+    for name in names:
+        BENCHMARKS[name](*sizes)
@@ -0,0 +1,257 @@
+'''
+Declarative indicators over long bar frames (symbol, timestamp, open/high/low/close/volume):
+every indicator declares its inputs (other indicators or frame columns) and the parameters it reads, a request for a set of
+indicators resolves the dependency DAG and computes every intermediate (prior close, log returns, true range, EMAs, ...)
+once per frame and parameter values. A FeatureSet lives for one heartbeat: add_columns-like features, ATR stops, MACD/RSI
+all read the same cached arrays.
+    features = FeatureSet(prices_df)                                  # sorts by symbol and time once
+    atr = features.latest(['atr'], atr_period=14)['atr'].to_dict()    # {symbol: ATR}
+    df = features.frame(['ema', 'volat', 'rsi', 'macd_hist'], span=78)
+Arrays are in (symbol, timestamp) order, oldest bar first; kernels come from bar_kernels (numba if installed).
+New indicators: @register('name', inputs=('close', ...), params=('window',)) def name(features, close, ..., window): ...
+'''
+import numpy as np
+import pandas as pd
+
+from bar_kernels import INDICATOR_FEATURES, compact_bars, segmented_ewma, segmented_rolling_mean, segmented_rolling_std, true_range
+
+
+DEFAULT_PARAMS = {
+    'span': 78, 'weekperiod': 130, # add_columns windows for 15min bars
+    'atr_period': 14, 'wilder': False,
+    'rsi_period': 14,
+    'macd_fast': 12, 'macd_slow': 26, 'macd_signal': 9,
+    'bb_window': 20, 'bb_width': 2.0,
+    'intraday_window': 5,
+}
+COLUMNS = ('open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap')
+
+
+class Indicator:
+
+    def __init__(self, name, func, inputs=(), params=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = tuple(params)
+
+
+REGISTRY = {}
+
+
+def register(name, inputs=(), params=()):
+    '''decorator: func(features, *input arrays, **params) -> array aligned with the sorted frame'''
+    def decorator(func):
+        REGISTRY[name] = Indicator(name, func, inputs, params)
+        return func
+    return decorator
+
+
+def resolve(names):
+    '''dependencies first, every indicator once (depth-first topological order); frame columns are leaves'''
+    ordered, state = [], {}
+
+    def visit(name, path):
+        if name in COLUMNS and name not in REGISTRY:
+            return
+        if name not in REGISTRY:
+            raise KeyError(f'Unknown indicator {name} (needed by {" -> ".join(path) or "request"})')
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError(f'Indicator cycle: {" -> ".join(path + [name])}')
+        state[name] = 'visiting'
+        for dependency in REGISTRY[name].inputs:
+            visit(dependency, path + [name])
+        state[name] = 'done'
+        ordered.append(name)
+
+    for name in names:
+        visit(name, [])
+    return ordered
+
+
+class FeatureSet:
+    '''one frame for one heartbeat; results are memoized per (indicator, values of the parameters it depends on)'''
+
+    def __init__(self, df, time_column='timestamp'):
+        codes = pd.factorize(df['symbol'], sort=True)[0]
+        order = np.lexsort((df[time_column].to_numpy(), codes))
+        self.df = df.iloc[order].reset_index(drop=True)
+        sorted_codes = codes[order]
+        self.starts = np.flatnonzero(np.concatenate(([True], sorted_codes[1:] != sorted_codes[:-1]))) if len(order) else np.zeros(0, dtype=np.int64)
+        self.ends = np.append(self.starts[1:], len(order)) - 1
+        self.cache = {}
+        self.computed = 0
+        self.hits = 0
+
+
+    def _param_names(self, name):
+        '''parameters read by an indicator and everything below it (the part of the cache key that matters)'''
+        if name not in REGISTRY:
+            return set()
+        names = set(REGISTRY[name].params)
+        for dependency in REGISTRY[name].inputs:
+            names |= self._param_names(dependency)
+        return names
+
+
+    def get(self, name, **params):
+        params = {**DEFAULT_PARAMS, **params}
+        for step in resolve([name]):
+            self._compute(step, params)
+        if name not in REGISTRY:
+            return self.df[name].to_numpy(dtype=float)
+        return self.cache[self._key(name, params)]
+
+
+    def _key(self, name, params):
+        return (name,) + tuple(sorted((param, params[param]) for param in self._param_names(name)))
+
+
+    def _compute(self, name, params):
+        key = self._key(name, params)
+        if key in self.cache:
+            self.hits += 1
+            return
+        indicator = REGISTRY[name]
+        inputs = [self.cache[self._key(dependency, params)] if dependency in REGISTRY else self.df[dependency].to_numpy(dtype=float)
+                  for dependency in indicator.inputs]
+        self.cache[key] = indicator.func(self, *inputs, **{param: params[param] for param in indicator.params})
+        self.computed += 1
+
+
+    def frame(self, names, **params):
+        '''sorted frame with one column per requested indicator'''
+        return self.df.assign(**{name: self.get(name, **params) for name in names})
+
+
+    def latest(self, names, **params):
+        '''value at the latest bar of every symbol, indexed by symbol'''
+        return pd.DataFrame({name: self.get(name, **params)[self.ends] for name in names}, index=pd.Index(self.df['symbol'].to_numpy()[self.ends], name='symbol'))
+
+
+# ---- intermediates shared by several indicators
+
+@register('prior_close', inputs=('close',))
+def prior_close(features, close):
+    prior = np.empty(len(close))
+    prior[1:] = close[:-1]
+    prior[features.starts] = np.nan
+    return prior
+
+
+@register('price_change', inputs=('close', 'prior_close'))
+def price_change(features, close, prior_close):
+    return close - prior_close
+
+
+@register('true_range', inputs=('high', 'low', 'close'))
+def true_range_indicator(features, high, low, close):
+    return true_range(high, low, close, features.starts)
+
+
+# ---- add_columns features (in time order) and their intermediates logret, running_max: the definitions of
+# bar_kernels.INDICATOR_FEATURES, so add_columns and a FeatureSet compute them the same way
+
+def _register_feature(name, inputs, windows, func):
+    register(name, inputs=inputs, params=windows)(lambda features, *arrays, **params: func(features.starts, *arrays, **params))
+
+
+for _name, (_inputs, _windows, _func) in INDICATOR_FEATURES.items():
+    _register_feature(_name, _inputs, _windows, _func)
+
+
+# ---- stops, momentum, bands
+
+@register('atr', inputs=('true_range',), params=('atr_period', 'wilder'))
+def atr(features, true_range, atr_period, wilder):
+    if wilder:
+        return segmented_ewma(true_range, features.starts, span=2 * atr_period - 1)
+    return segmented_rolling_mean(true_range, features.starts, atr_period, min_periods=1)
+
+
+@register('rsi', inputs=('price_change',), params=('rsi_period',))
+def rsi(features, price_change, rsi_period):
+    '''Wilder RSI: averages of gains and losses smoothed with alpha 1/period (first bar of a symbol has no change)'''
+    gains = np.where(np.isnan(price_change), np.nan, np.clip(price_change, 0, None))
+    losses = np.where(np.isnan(price_change), np.nan, np.clip(-price_change, 0, None))
+    average_gain = segmented_ewma(gains, features.starts, span=2 * rsi_period - 1)
+    average_loss = segmented_ewma(losses, features.starts, span=2 * rsi_period - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(average_loss == 0, np.where(average_gain == 0, 50.0, 100.0), 100 - 100 / (1 + average_gain / average_loss))
+
+
+@register('ema_fast', inputs=('close',), params=('macd_fast',))
+def ema_fast(features, close, macd_fast):
+    return segmented_ewma(close, features.starts, macd_fast)
+
+
+@register('ema_slow', inputs=('close',), params=('macd_slow',))
+def ema_slow(features, close, macd_slow):
+    return segmented_ewma(close, features.starts, macd_slow)
+
+
+@register('macd', inputs=('ema_fast', 'ema_slow'))
+def macd(features, ema_fast, ema_slow):
+    return ema_fast - ema_slow
+
+
+@register('macd_signal', inputs=('macd',), params=('macd_signal',))
+def macd_signal(features, macd, macd_signal):
+    return segmented_ewma(macd, features.starts, macd_signal)
+
+
+@register('macd_hist', inputs=('macd', 'macd_signal'))
+def macd_hist(features, macd, macd_signal):
+    return macd - macd_signal
+
+
+@register('bb_mid', inputs=('close',), params=('bb_window',))
+def bb_mid(features, close, bb_window):
+    return segmented_rolling_mean(close, features.starts, bb_window)
+
+
+@register('bb_std', inputs=('close',), params=('bb_window',))
+def bb_std(features, close, bb_window):
+    return segmented_rolling_std(close, features.starts, bb_window)
+
+
+@register('bb_upper', inputs=('bb_mid', 'bb_std'), params=('bb_width',))
+def bb_upper(features, bb_mid, bb_std, bb_width):
+    return bb_mid + bb_width * bb_std
+
+
+@register('bb_lower', inputs=('bb_mid', 'bb_std'), params=('bb_width',))
+def bb_lower(features, bb_mid, bb_std, bb_width):
+    return bb_mid - bb_width * bb_std
+
+
+# ---- daily_intraday_volatilty of ok_Long_SPY_ON_from_Dan.py
+
+@register('intraday_gain', inputs=('close', 'open'))
+def intraday_gain(features, close, open):
+    return np.log(close / open)
+
+
+@register('intraday_volatility', inputs=('intraday_gain',), params=('intraday_window',))
+def intraday_volatility(features, intraday_gain, intraday_window):
+    return segmented_rolling_std(intraday_gain, features.starts, intraday_window)
+
+
+def compact_drift(df, names=('ema', 'ret1w', 'drawdown', 'volat', 'streak', 'atr', 'rsi', 'macd_hist', 'bb_upper'), rtol=1e-4, **params):
+    '''
+    Numerical drift of indicators from bar_kernels.compact_bars(df) (float32 prices) against the full precision frame:
+    max absolute difference, the same relative to the median magnitude of the indicator, and the rows differing beyond rtol.
+        print(compact_drift(prices_df, span=78))
+    '''
+    full, compact = FeatureSet(df), FeatureSet(compact_bars(df))
+    rows = {}
+    for name in names:
+        reference, values = full.get(name, **params), compact.get(name, **params)
+        difference = np.abs(values - reference)
+        scale = np.nanmedian(np.abs(reference)) if np.isfinite(reference).any() else 0.0
+        rows[name] = {'max_abs': np.nanmax(difference) if np.isfinite(difference).any() else 0.0,
+                      'max_rel': np.nanmax(difference) / scale if scale > 0 and np.isfinite(difference).any() else 0.0,
+                      'changed_rows': int((~np.isclose(values, reference, rtol=rtol, atol=rtol * scale, equal_nan=True)).sum())}
+    return pd.DataFrame.from_dict(rows, orient='index')
@@ -35,6 +35,8 @@ import math
 import numpy as np
 import pandas as pd
 
+from indicator_registry import FeatureSet
+
 # Set constants
 
     # Intraday I actually short DIA (not SPY): Alpaca doesn't allow moving a position from long to short (or vice versa) in a single step. 
@@ -209,10 +211,9 @@ def daily_intraday_volatilty(stock):
       adjustment= Adjustment.RAW,
       feed = DataFeed.SIP
       )
-  bar_data = stock_client.get_stock_bars(bars_request_params).df.droplevel(level=0) # drop level is needed as 1st it appears with multiindex with symbol
-  bar_data['intra_day_gain'] = np.log(bar_data.close/bar_data.open)
-  bar_data['volatility'] = bar_data.rolling(PREV_STD_DAYS).intra_day_gain.std()
-  volatility = bar_data.volatility[-1]
+  bar_data = stock_client.get_stock_bars(bars_request_params).df.reset_index()
+  # rolling std of log(close/open) over PREV_STD_DAYS from the shared indicator registry (same intermediates as the other strategies)
+  volatility = FeatureSet(bar_data).latest(['intraday_volatility'], intraday_window=PREV_STD_DAYS)['intraday_volatility'].iloc[-1]
   log.debug('intraday volatility calc: {}'.format(volatility))
 
   return volatility
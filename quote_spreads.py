@@ -0,0 +1,107 @@
+'''
+Bid/ask spreads of many symbols as array operations. Quotes are taken in the raw JSON form of the data API
+(StockHistoricalDataClient(raw_data=True): {symbol: {'bp': bid, 'ap': ask, ...}}), so no pydantic Quote is built per symbol.
+    spreads_df = latest_spreads(alpaca_instance.raw_quotes(symbols))     # symbol, spread, crossed
+spread = (ask - bid) / ask as in get_ok_alpaca_stocks. Quotes without a positive bid and ask get NaN,
+crossed quotes (bid > ask, usually stale or erroneous) are flagged.
+One latest quote is noisy, time_weighted_spreads summarizes short windows of historical quotes per symbol instead
+(MyAlpaca.spread_quality, once a day): every quote counts for the time it was the current quote.
+'''
+import numpy as np
+import pandas as pd
+
+
+def quote_arrays(raw_quotes):
+    '''{symbol: raw quote} => (symbols, bid, ask) arrays; missing prices are NaN'''
+    symbols = np.array(list(raw_quotes), dtype=object)
+    prices = np.array([(quote.get('bp'), quote.get('ap')) if quote else (None, None) for quote in raw_quotes.values()],
+                      dtype=np.float64).reshape(-1, 2)
+    return symbols, prices[:, 0], prices[:, 1]
+
+
+def spread_arrays(bid, ask):
+    '''(spread, crossed): relative spread against the ask, NaN unless bid and ask are positive'''
+    valid = (bid > 0) & (ask > 0) # NaN compares False
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spread = np.where(valid, (ask - bid) / ask, np.nan)
+    return spread, valid & (bid > ask)
+
+
+def latest_spreads(raw_quotes):
+    '''compact frame (symbol, spread as float32, crossed) of the quotes with a valid spread'''
+    symbols, bid, ask = quote_arrays(raw_quotes)
+    spread, crossed = spread_arrays(bid, ask)
+    valid = ~np.isnan(spread)
+    return pd.DataFrame({'symbol': symbols[valid], 'spread': spread[valid].astype(np.float32), 'crossed': crossed[valid]})
+
+
+def quote_history_arrays(raw_quotes, window_end, max_quotes=None):
+    '''
+    {symbol: [raw quotes, time ascending]} of one window ending at window_end (int64 ns UTC; get_stock_quotes with raw_data=True) =>
+    (symbols, counts, spread, seconds): per quote its spread (NaN if missing or crossed) and the seconds it was the current quote
+    (till the next quote of the symbol, the last one till window_end). max_quotes: only the first max_quotes quotes of a symbol
+    are kept, its window then ends at the first dropped quote.
+    '''
+    symbols = np.array([symbol for symbol, quotes in raw_quotes.items() if quotes], dtype=object)
+    kept = [raw_quotes[symbol][:max_quotes] for symbol in symbols]
+    counts = np.array([len(quotes) for quotes in kept], dtype=np.int64)
+    quotes = [quote for symbol_quotes in kept for quote in symbol_quotes]
+    timestamps = pd.to_datetime([quote['t'] for quote in quotes], utc=True, format='ISO8601').as_unit('ns').asi8
+    prices = np.array([(quote.get('bp'), quote.get('ap')) for quote in quotes], dtype=np.float64).reshape(-1, 2)
+    ends = np.full(len(symbols), window_end, dtype=np.int64)
+    cut = [row for row, symbol in enumerate(symbols) if max_quotes and len(raw_quotes[symbol]) > max_quotes]
+    if cut:
+        ends[cut] = pd.to_datetime([raw_quotes[symbols[row]][max_quotes]['t'] for row in cut], utc=True, format='ISO8601').as_unit('ns').asi8
+
+    spread, crossed = spread_arrays(prices[:, 0], prices[:, 1])
+    next_timestamp = np.empty(len(timestamps), dtype=np.int64)
+    next_timestamp[:-1] = timestamps[1:]
+    next_timestamp[np.cumsum(counts) - 1] = ends # last quote of every symbol lasts till its window end
+    usable = ~np.isnan(spread) & ~crossed
+    seconds = np.where(usable, np.clip(next_timestamp - timestamps, 0, None) / 1e9, 0.0)
+    return symbols, counts, np.where(usable, spread, np.nan), seconds
+
+
+def weighted_quantiles(values, weights, starts, quantiles):
+    '''
+    per segment and quantile q: the smallest value whose cumulative weight reaches q of the segment's weight
+    (values sorted inside each segment), NaN for segments without weight => array (len(starts), len(quantiles))
+    '''
+    n = len(values)
+    segment_ids = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+    order = np.lexsort((values, segment_ids))
+    sorted_values, sorted_weights = values[order], weights[order]
+    cumulative = np.cumsum(sorted_weights)
+    before = np.concatenate(([0.0], cumulative))[starts] # weight of all earlier segments
+    total = np.add.reduceat(sorted_weights, starts) if n else np.zeros(0)
+    within = cumulative - before[segment_ids]
+    result = np.full((len(starts), len(quantiles)), np.nan)
+    for column, q in enumerate(quantiles):
+        reached = (within >= q * total[segment_ids]) & (sorted_weights > 0)
+        first = np.minimum.reduceat(np.where(reached, np.arange(n), n), starts) if n else np.zeros(0, dtype=np.int64)
+        found = (total > 0) & (first < n)
+        result[found, column] = sorted_values[first[found]]
+    return result
+
+
+def time_weighted_spreads(parts):
+    '''
+    Time-weighted median and p90 spread per symbol over quote arrays of one or more windows (list of quote_history_arrays
+    results; a symbol may be in several). Compact frame, symbols ascending:
+    symbol, spread_median, spread_p90 (float32), quotes (valid quotes), seconds (time covered by valid quotes).
+    '''
+    names = np.concatenate([np.repeat(symbols, counts) for symbols, counts, _, _ in parts] or [np.zeros(0, dtype=object)])
+    spread = np.concatenate([part[2] for part in parts] or [np.zeros(0)])
+    seconds = np.concatenate([part[3] for part in parts] or [np.zeros(0)])
+    codes, symbols = pd.factorize(names, sort=True)
+    order = np.argsort(codes, kind='stable') # one segment per symbol
+    spread, seconds = spread[order], seconds[order]
+    counts = np.bincount(codes, minlength=len(symbols))
+    starts = np.cumsum(counts) - counts
+    usable = ~np.isnan(spread)
+    quantiles = weighted_quantiles(np.where(usable, spread, np.inf), seconds, starts, (0.5, 0.9))
+    n = len(spread)
+    return pd.DataFrame({'symbol': np.asarray(symbols, dtype=object), 'spread_median': quantiles[:, 0].astype(np.float32),
+                         'spread_p90': quantiles[:, 1].astype(np.float32),
+                         'quotes': np.add.reduceat(usable.astype(np.int64), starts) if n else np.zeros(0, dtype=np.int64),
+                         'seconds': np.add.reduceat(seconds, starts).astype(np.float32) if n else np.zeros(0, dtype=np.float32)})
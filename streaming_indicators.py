@@ -0,0 +1,269 @@
+'''
+Stateful indicators for streaming strategies (ws examples): every new bar is one O(1) update(...) instead of recomputing
+talib/ta functions over the whole growing close array on each message.
+    rsi = RSI(14)
+    value = rsi.update(close)              # None until enough bars were seen
+    macd = MACD(12, 26, 9, keep=3)
+    macd.seed(history_closes)              # warm up from historical bars
+    macd.update(close, replace=True)       # the current (still forming) bar changed: replaces the last update
+Conventions match indicator_registry (the batch versions): EMA = ewm(span, adjust=False) seeded with the first price,
+Wilder smoothing = EMA with alpha 1/period, rolling std with ddof=1. RSI(seed='sma') starts from the mean of the first
+period changes like talib.RSI. EMA/MACD(adjust=True) give the values of ta.macd instead: ewm(span, min_periods=span),
+NaN until span prices were seen.
+'''
+import collections
+import math
+
+
+class StreamingIndicator:
+    '''update(..., replace=True) re-does the last update with new values (second bars aggregated into the current minute)'''
+
+    def __init__(self, keep=1):
+        self.values = collections.deque(maxlen=keep) # latest outputs, values[-1] is the current one
+        self._previous = None
+        self._updated = False
+
+
+    def update(self, *bar, replace=False):
+        if replace and self._updated:
+            self._load(self._previous)
+            if self.values:
+                self.values.pop()
+        self._previous = self._dump()
+        self._updated = True
+        value = self._update(*bar)
+        self.values.append(value)
+        return value
+
+
+    def seed(self, bars):
+        '''bars: prices (or (high, low, close) tuples for ATR) oldest first'''
+        for bar in bars:
+            self.update(*(bar if isinstance(bar, tuple) else (bar,)))
+        return self.value
+
+
+    @property
+    def value(self):
+        return self.values[-1] if self.values else None
+
+
+class EMA(StreamingIndicator):
+    '''adjust=True: pandas ewm(adjust=True, min_periods=period) as in ta.macd, NaN before period prices'''
+
+    def __init__(self, period, alpha=None, keep=1, adjust=False):
+        super().__init__(keep)
+        self.alpha = alpha if alpha is not None else 2 / (period + 1)
+        self.adjust = adjust
+        self.min_periods = period if adjust else 1
+        self.mean = None
+        self.weight = 0.0 # weight of the old mean, as in pandas' ewma
+        self.count = 0
+
+
+    def _dump(self):
+        return self.mean, self.weight, self.count
+
+
+    def _load(self, state):
+        self.mean, self.weight, self.count = state
+
+
+    def _update(self, price):
+        self.count += 1
+        if self.mean is None:
+            self.mean, self.weight = float(price), 1.0
+        else: # same rounding as pandas ewm
+            new_weight = 1.0 if self.adjust else self.alpha
+            self.weight *= 1 - self.alpha
+            self.mean = (self.weight * self.mean + new_weight * price) / (self.weight + new_weight)
+            self.weight = self.weight + new_weight if self.adjust else 1.0
+        return self.mean if self.count >= self.min_periods else float('nan')
+
+
+class MACD(StreamingIndicator):
+    '''
+    value is the histogram (macd - signal) or with output='macd' the macd line; both lines are attributes.
+    adjust=True for the values of ta.macd (NaN for the first slow - 1 prices).
+    '''
+
+    def __init__(self, fast=12, slow=26, signal=9, keep=1, output='hist', adjust=False):
+        super().__init__(keep)
+        self.fast, self.slow, self.signal_ema = EMA(fast, adjust=adjust), EMA(slow, adjust=adjust), EMA(signal, adjust=adjust)
+        self.output = output
+        self.macd = self.signal = None
+
+
+    def _dump(self):
+        return self.fast._dump(), self.slow._dump(), self.signal_ema._dump(), self.macd, self.signal
+
+
+    def _load(self, state):
+        fast, slow, signal, self.macd, self.signal = state
+        self.fast._load(fast)
+        self.slow._load(slow)
+        self.signal_ema._load(signal)
+
+
+    def _update(self, price):
+        self.macd = self.fast._update(price) - self.slow._update(price)
+        if not math.isnan(self.macd): # the signal EMA starts with the first macd value, like ewm skipping leading NaN
+            self.signal = self.signal_ema._update(self.macd)
+        elif self.signal is None:
+            self.signal = float('nan')
+        return self.macd if self.output == 'macd' else self.macd - self.signal
+
+
+class RSI(StreamingIndicator):
+    '''
+    Wilder RSI. seed='sma': first averages are the means of the first period gains/losses (talib.RSI, None before that);
+    seed='ewm': averages are EMAs with alpha 1/period from the first change on (indicator_registry rsi).
+    '''
+
+    def __init__(self, period=14, seed='sma', keep=1):
+        super().__init__(keep)
+        self.period = period
+        self.seed_mode = seed
+        self.previous_close = None
+        self.average_gain = self.average_loss = 0.0
+        self.changes = 0
+
+
+    def _dump(self):
+        return self.previous_close, self.average_gain, self.average_loss, self.changes
+
+
+    def _load(self, state):
+        self.previous_close, self.average_gain, self.average_loss, self.changes = state
+
+
+    def _update(self, price):
+        price = float(price)
+        if self.previous_close is None:
+            self.previous_close = price
+            return None
+        change = price - self.previous_close
+        self.previous_close = price
+        gain, loss = max(change, 0.0), max(-change, 0.0)
+        self.changes += 1
+        if self.seed_mode == 'sma' and self.changes <= self.period:
+            self.average_gain += gain / self.period # sums up to the simple mean of the first period changes
+            self.average_loss += loss / self.period
+            if self.changes < self.period:
+                return None
+        elif self.changes == 1: # ewm seed: the first change
+            self.average_gain, self.average_loss = gain, loss
+        else:
+            self.average_gain = (self.average_gain * (self.period - 1) + gain) / self.period
+            self.average_loss = (self.average_loss * (self.period - 1) + loss) / self.period
+        if self.average_loss == 0:
+            return 50.0 if self.average_gain == 0 else 100.0
+        return 100 - 100 / (1 + self.average_gain / self.average_loss)
+
+
+class _RollingWindow:
+    '''sum and sum of squares of the last size values, shifted by the first value against cancellation, refreshed now and then'''
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = [0.0] * size
+        self.count = self.position = self.pushes = 0
+        self.shift = None
+        self.total = self.total_sq = 0.0
+
+
+    def dump(self):
+        return self.count, self.position, self.pushes, self.shift, self.total, self.total_sq, self.buffer[self.position]
+
+
+    def load(self, state):
+        self.count, self.position, self.pushes, self.shift, self.total, self.total_sq, evicted = state
+        self.buffer[self.position] = evicted
+
+
+    def push(self, value):
+        if self.shift is None:
+            self.shift = value
+        value -= self.shift
+        if self.count == self.size:
+            evicted = self.buffer[self.position]
+            self.total -= evicted
+            self.total_sq -= evicted * evicted
+        else:
+            self.count += 1
+        self.buffer[self.position] = value
+        self.position = (self.position + 1) % self.size
+        self.total += value
+        self.total_sq += value * value
+        self.pushes += 1
+        if self.pushes % (self.size * 64) == 0: # exact sums again, amortized O(1)
+            window = self.buffer[:self.count] if self.count < self.size else self.buffer
+            self.total = math.fsum(window)
+            self.total_sq = math.fsum(v * v for v in window)
+
+
+    def mean(self):
+        return self.shift + self.total / self.count
+
+
+    def std(self):
+        if self.count < 2:
+            return float('nan')
+        return math.sqrt(max(0.0, (self.total_sq - self.total * self.total / self.count) / (self.count - 1)))
+
+
+class ATR(StreamingIndicator):
+    '''update(high, low, close); wilder=True: Wilder smoothing, else rolling mean of TR over period bars (min_periods=1)'''
+
+    def __init__(self, period=14, wilder=True, keep=1):
+        super().__init__(keep)
+        self.wilder = wilder
+        self.previous_close = None
+        self.smoothed = EMA(period, alpha=1 / period) if wilder else None
+        self.window = None if wilder else _RollingWindow(period)
+
+
+    def _dump(self):
+        return self.previous_close, self.smoothed._dump() if self.wilder else self.window.dump()
+
+
+    def _load(self, state):
+        self.previous_close, inner = state
+        self.smoothed._load(inner) if self.wilder else self.window.load(inner)
+
+
+    def _update(self, high, low, close):
+        if self.previous_close is None:
+            true_range = high - low
+        else:
+            true_range = max(high, self.previous_close) - min(low, self.previous_close)
+        self.previous_close = close
+        if self.wilder:
+            return self.smoothed._update(true_range)
+        self.window.push(true_range)
+        return self.window.mean()
+
+
+class BollingerBands(StreamingIndicator):
+    '''value is (mid, upper, lower), None until window prices were seen'''
+
+    def __init__(self, window=20, width=2.0, keep=1):
+        super().__init__(keep)
+        self.width = width
+        self.window = _RollingWindow(window)
+
+
+    def _dump(self):
+        return self.window.dump()
+
+
+    def _load(self, state):
+        self.window.load(state)
+
+
+    def _update(self, price):
+        self.window.push(float(price))
+        if self.window.count < self.window.size:
+            return None
+        mid, std = self.window.mean(), self.window.std()
+        return mid, mid + self.width * std, mid - self.width * std
@@ -0,0 +1,118 @@
+'''
+Named universes of Universes.py as frozensets plus an inverted index symbol -> universe names, built once at import.
+Lists are universes of their symbols, dicts of their keys (the values are descriptions). Symbols are normalized to
+Alpaca notation ('BRK-B' -> 'BRK.B'); Refinitiv RICs (SP500_memb_2011_2021_RIC, e.g. 'SNI.OQ^C18' = SNI on Nasdaq,
+delisted March 2018) become their Alpaca symbol, with exchange and delisting month kept in RICS. A symbol can be reused
+after a delisting, so DELISTED holds all delisting months of a symbol.
+With bar_cache_dir set the RIC table is persisted there (universe_rics.json) and parsed again only when Universes.py changes.
+    resolve('Spiders')                    # ['XLB', 'XLE', ...] in the order of Universes.py
+    'XLE' in UNIVERSES['Spiders']         # O(1)
+    universes_of('XLE')                   # frozenset({'Spiders', 'USAssetClasses'})
+    DELISTED['SNI']                       # ('2018-03',)
+'''
+import hashlib
+import json
+import os
+import re
+
+import Universes
+
+
+RIC_PATTERN = re.compile(r'([A-Z0-9]+)([a-z]?)\.([A-Z]+)(?:\^([A-L])(\d{2}))?')
+RIC_EXCHANGES = {'N': 'NYSE', 'OQ': 'NASDAQ', 'Z': 'BATS'}
+RIC_CACHE_FILE = os.path.join(os.getenv('bar_cache_dir'), 'universe_rics.json') if os.getenv('bar_cache_dir') else None
+
+
+def normalize_symbol(symbol):
+    '''Alpaca notation: upper case, share classes with a dot (BRK-B, BRK/B -> BRK.B)'''
+    return re.sub(r'[-/]', '.', symbol.strip().upper())
+
+
+def parse_ric(ric):
+    '''
+    'SNI.OQ^C18' -> ('SNI', 'NASDAQ', '2018-03'), 'BRKb.N' -> ('BRK.B', 'NYSE', None); None if it is no RIC.
+    The suffix after ^ is the delisting month (A = January ... L = December) and year.
+    '''
+    match = RIC_PATTERN.fullmatch(ric.strip())
+    if match is None:
+        return None
+    root, share_class, exchange, month, year = match.groups()
+    symbol = f'{root}.{share_class.upper()}' if share_class else root
+    delisted = f'20{year}-{ord(month) - ord("A") + 1:02d}' if month else None
+    return symbol, RIC_EXCHANGES.get(exchange, exchange), delisted
+
+
+def _ric_lists():
+    return {name: values for name, values in vars(Universes).items() if name.endswith('_RIC') and isinstance(values, list)}
+
+
+def _load_rics():
+    '''{ric: (symbol, exchange, delisted)} from the persisted table if Universes.py did not change, else parsed (and saved)'''
+    if RIC_CACHE_FILE is None: # nothing is written into the checkout
+        return {ric: parse_ric(ric) for values in _ric_lists().values() for ric in values}
+    with open(Universes.__file__, 'rb') as f:
+        source_hash = hashlib.sha1(f.read()).hexdigest()
+    try:
+        with open(RIC_CACHE_FILE) as f:
+            cached = json.load(f)
+        if cached['source_hash'] == source_hash:
+            return {ric: tuple(parsed) if parsed else None for ric, parsed in cached['rics'].items()}
+    except (OSError, ValueError, KeyError):
+        pass
+    rics = {ric: parse_ric(ric) for values in _ric_lists().values() for ric in values}
+    try:
+        with open(RIC_CACHE_FILE + '.tmp', 'w') as f:
+            json.dump({'source_hash': source_hash, 'rics': rics}, f)
+        os.replace(RIC_CACHE_FILE + '.tmp', RIC_CACHE_FILE)
+    except OSError: # read-only cache dir: parsed again next time
+        pass
+    return rics
+
+
+RICS = _load_rics()
+UNPARSED_RICS = frozenset(ric for ric, parsed in RICS.items() if parsed is None) # e.g. stray entries like '8'
+
+
+def _delisted():
+    '''symbol -> its delisting months ascending (a reused symbol has several)'''
+    months = {}
+    for parsed in RICS.values():
+        if parsed and parsed[2]:
+            months.setdefault(parsed[0], set()).add(parsed[2])
+    return {symbol: tuple(sorted(dates)) for symbol, dates in months.items()}
+
+
+DELISTED = _delisted()
+
+
+def _build():
+    ordered = {}
+    for name, values in vars(Universes).items():
+        if name.startswith('_') or not isinstance(values, (list, tuple, dict)):
+            continue
+        if name in _ric_lists():
+            symbols = [RICS[ric][0] for ric in values if RICS.get(ric)]
+        else:
+            symbols = [normalize_symbol(symbol) for symbol in values if isinstance(symbol, str)]
+        ordered[name] = tuple(dict.fromkeys(symbols)) # order of Universes.py, duplicates dropped
+    index = {}
+    for name, symbols in ordered.items():
+        for symbol in symbols:
+            index.setdefault(symbol, set()).add(name)
+    return ordered, {name: frozenset(symbols) for name, symbols in ordered.items()}, {symbol: frozenset(names) for symbol, names in index.items()}
+
+
+ORDERED, UNIVERSES, SYMBOL_INDEX = _build()
+
+
+def resolve(name):
+    '''symbols of a named universe in the order of Universes.py, [] for unknown names'''
+    return list(ORDERED.get(name, ()))
+
+
+def universes_of(symbol):
+    return SYMBOL_INDEX.get(normalize_symbol(symbol), frozenset())
+
+
+def is_member(symbol, name):
+    return normalize_symbol(symbol) in UNIVERSES.get(name, frozenset())
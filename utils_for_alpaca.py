@@ -7,9 +7,14 @@ from github import Github
 from github.GithubException import UnknownObjectException, GithubException
 import io
 import concurrent.futures
+import threading
+import weakref
+import json
+import heapq
+import re
+import tempfile
+import requests
 from typing import List, Dict
-from itertools import repeat
-from dateutil.relativedelta import relativedelta
 
 
 import logging
@@ -31,6 +36,14 @@ from alpaca.trading.client import TradingClient
 from alpaca.data import StockHistoricalDataClient
 from alpaca.broker.client import BrokerClient
 
+from bar_kernels import (add_indicator_columns, compact_bars, indicator_segments, last_n_per_symbol, price_direction, regular_session_mask,
+                         segmented_cummax, segmented_ewma, segmented_pct_change, segmented_rolling_std, segmented_streak, to_ny_local)
+from async_market_data import AsyncMarketData
+from indicator_registry import FeatureSet
+from volume_profile import VolumeProfile
+from quote_spreads import latest_spreads, quote_history_arrays, time_weighted_spreads
+import universe_registry
+
 
 sender_address = os.environ['sender_address']
 receiver_address =os.environ['receiver_address']
@@ -58,9 +71,169 @@ logger.addHandler(console_handler)
 # logger.error("This is an error message, will be sent via email")
 
 
+class RateLimiter:
+    '''
+    Process-wide token bucket shared by all alpaca-py clients of all MyAlpaca instances (Alpaca allows ~200 requests/minute).
+    Waiting requests are served strictly by priority class, then FIFO: orders > account/clock/order polling > snapshots/quotes > bulk history.
+    Bulk history may not take the last `reserve` share of the bucket, so an order never waits behind a burst of bar downloads.
+    '''
+    ORDER, ACCOUNT, DATA, BULK = 0, 1, 2, 3
+    PRIORITY_NAMES = {ORDER: 'order', ACCOUNT: 'account', DATA: 'data', BULK: 'bulk'}
+
+    def __init__(self, requests_per_minute=200, burst=None, reserve=0.2):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst or max(1, requests_per_minute // 6)
+        self.bulk_reserve = reserve * self.capacity
+        self.capacity = max(self.capacity, 1 + self.bulk_reserve) # a bulk request needs 1 + reserve tokens, the bucket must hold them
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiting = [] # heap of (priority, sequence)
+        self.sequence = 0
+        self.counters = {'granted': {name: 0 for name in self.PRIORITY_NAMES.values()}, 'queued': 0, 'throttled': 0, 'wait_seconds': 0.0}
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+
+    def acquire(self, priority=BULK):
+        with self.cond:
+            self.sequence += 1
+            entry = (priority, self.sequence)
+            heapq.heappush(self.waiting, entry)
+            needed = 1 + (self.bulk_reserve if priority == self.BULK else 0)
+            started = time.monotonic()
+            queued = False
+            while True:
+                self._refill()
+                if self.waiting[0] == entry and self.tokens >= needed:
+                    break
+                queued = True
+                timeout = (needed - self.tokens) / self.rate if self.waiting[0] == entry else 1.0
+                self.cond.wait(timeout=max(0.01, min(timeout, 1.0)))
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.counters['granted'][self.PRIORITY_NAMES[priority]] += 1
+            if queued:
+                self.counters['queued'] += 1
+                self.counters['wait_seconds'] += time.monotonic() - started
+            self.cond.notify_all() # next head re-checks
+
+
+    def throttled(self):
+        '''HTTP 429 (or other retried status): empty the bucket so every waiting request slows down'''
+        with self.cond:
+            self.counters['throttled'] += 1
+            self.tokens = 0
+            self.last_refill = time.monotonic()
+
+
+    def stats(self):
+        with self.cond:
+            return {**self.counters, 'granted': dict(self.counters['granted']), 'waiting_now': len(self.waiting), 'tokens': round(self.tokens, 1)}
+
+
+    @classmethod
+    def request_priority(cls, method, url):
+        method = method.upper()
+        if '/orders' in url and method in ('POST', 'DELETE', 'PATCH'):
+            return cls.ORDER
+        if 'data.alpaca.markets' in url or 'data.sandbox.alpaca.markets' in url:
+            return cls.BULK if any(endpoint in url for endpoint in ('/bars', '/quotes', '/trades')) and '/latest' not in url else cls.DATA
+        return cls.ACCOUNT
+
+
+    def attach(self, client):
+        '''
+        routes every HTTP attempt (including SDK retries) of an alpaca-py REST client through the bucket: a requests transport
+        adapter mounted on the client's session (alpaca-py keeps a requests.Session in _session, pinned in requirements.txt)
+        '''
+        session = getattr(client, '_session', None)
+        if not isinstance(session, requests.Session):
+            logger.warning(f'{type(client).__name__} has no requests session, its calls are not rate limited')
+            return client
+        if not isinstance(session.get_adapter('https://'), RateLimitedAdapter):
+            adapter = RateLimitedAdapter(self)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return client
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    '''requests transport adapter taking a RateLimiter token per HTTP attempt'''
+
+    def __init__(self, limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire(self.limiter.request_priority(request.method, request.url))
+        response = super().send(request, **kwargs)
+        if response.status_code in (429, 504): # the SDK sleeps and retries these, everyone else should slow down too
+            self.limiter.throttled()
+        return response
+
+
+rate_limiter = RateLimiter(requests_per_minute=int(os.getenv('alpaca_requests_per_minute', 200)))
+
+
+class RequestCoalescer:
+    '''
+    Strategies running in the same process share identical market data requests:
+    a request whose key is already in flight waits for that result, a key finished less than ttl_seconds ago gets the stored result.
+    Results are handed out as copies (callers like add_columns change frames in place). Errors and empty results are not kept.
+    '''
+
+    def __init__(self, ttl_seconds=60):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = {} # key -> (future, finished_at or None)
+        self.counters = {'calls': 0, 'shared': 0}
+
+
+    def call(self, key, func):
+        with self.lock:
+            self.counters['calls'] += 1
+            now = time.monotonic()
+            for old_key in [k for k, (_, finished) in self.entries.items() if finished is not None and now - finished > self.ttl_seconds]:
+                del self.entries[old_key]
+            owner = key not in self.entries
+            if owner:
+                future = concurrent.futures.Future()
+                self.entries[key] = (future, None)
+            else:
+                future = self.entries[key][0]
+                self.counters['shared'] += 1
+
+        if owner:
+            try:
+                result = func()
+            except Exception as e:
+                with self.lock:
+                    self.entries.pop(key, None)
+                future.set_exception(e)
+                raise
+            with self.lock:
+                if result is None or (hasattr(result, '__len__') and len(result) == 0):
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = (future, time.monotonic())
+            future.set_result(result)
+
+        result = future.result()
+        return result.copy() if hasattr(result, 'copy') else result
+
+
+request_coalescer = RequestCoalescer(ttl_seconds=float(os.getenv('alpaca_coalesce_ttl', 60)))
+
+
 max_positions_allowed = 15
 def num_of_positions_ok(key, secret):
-    positions = TradingClient(key, secret).get_all_positions()    
+    positions = rate_limiter.attach(TradingClient(key, secret)).get_all_positions()    
     logger.info(f'Currently there {len(positions)} open positions, while {max_positions_allowed} are max allowed')
     return max_positions_allowed > len(positions)
 
@@ -175,13 +348,565 @@ def compare_dataframes(current_df, new_df, volume_threshold=0.1, trade_count_thr
         print(f"Comparison not possible: {e}")
 
 
+def _replace_file(path, write, mode='wb'):
+    '''
+    write(f) goes to a temporary file of its own next to path, which then replaces path: a killed process never leaves a
+    half-written file and concurrent writers never share a temporary file (the last complete write wins)
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class BarCache:
+    '''
+    Local on-disk cache of raw bars (UTC timestamps, extended hours included) as returned by get_stock_bars.
+    Layout is root/<timeframe_key>/<symbol>/<YYYY-MM>.pkl, one file per symbol and month holding the bars of its cached sessions
+    and the list of those sessions, so a range is read with one file per symbol and month (6 months: 7 reads per symbol).
+    timeframe_key already contains the adjustment (e.g. '5min_all'), so switching adjustment never mixes prices.
+    Only complete sessions are written; a session without bars is in the session list, so it is not requested again.
+    A symbol is only ever written by the download chunk holding it, so parallel chunks never write the same file. Processes
+    writing the same file each replace it with a complete one (the last write wins, sessions it lacks are downloaded again),
+    and an unreadable file counts as not cached.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+
+    def _symbol_dir(self, timeframe_key, symbol):
+        return os.path.join(self.root, timeframe_key, symbol.replace('/', '_')) # crypto-like symbols would break the path
+
+
+    def _month_path(self, timeframe_key, symbol, month):
+        return os.path.join(self._symbol_dir(timeframe_key, symbol), f'{month}.pkl')
+
+
+    @staticmethod
+    def _months(start_date, end_date):
+        return [str(month) for month in pd.period_range(start_date, end_date, freq='M')] if start_date <= end_date else []
+
+
+    def _load_month(self, path):
+        '''(sessions, bars) of a month file, (set(), None) if there is none or it is unreadable (its sessions are downloaded again)'''
+        if not os.path.exists(path):
+            return set(), None
+        try:
+            month = pd.read_pickle(path)
+            return set(month['sessions']), month['bars']
+        except Exception as e:
+            logger.warning(f'Bar cache file {path} not readable, its sessions are downloaded again: {e}')
+            return set(), None
+
+
+    def _save_month(self, path, sessions, bars):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique temporary file: strategies refreshing the same symbol never move each other's half-written pickle into place
+        _replace_file(path, lambda f: pd.to_pickle({'sessions': sorted(sessions), 'bars': bars.reset_index(drop=True)}, f))
+
+
+    @staticmethod
+    def _utc_bounds(start_date, end_date):
+        '''UTC timestamps of the first and after the last ET day of a date range'''
+        start = pd.Timestamp(start_date).tz_localize('America/New_York').tz_convert('UTC')
+        end = (pd.Timestamp(end_date) + pd.Timedelta(days=1)).tz_localize('America/New_York').tz_convert('UTC')
+        return start, end
+
+
+    def read(self, timeframe_key, symbols, start_date, end_date):
+        '''(bars of the cached sessions between the dates, {symbol: cached session dates between the dates})'''
+        frames, cached = [], {}
+        start, end = self._utc_bounds(start_date, end_date)
+        for symbol in symbols:
+            dates = set()
+            for month in self._months(start_date, end_date):
+                sessions, bars = self._load_month(self._month_path(timeframe_key, symbol, month))
+                dates.update(day for day in sessions if start_date <= day <= end_date)
+                if bars is not None and not bars.empty:
+                    frames.append(bars[(bars['timestamp'] >= start) & (bars['timestamp'] < end)])
+            cached[symbol] = dates
+        frames = [f for f in frames if not f.empty]
+        return (pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()), cached
+
+
+    def write(self, timeframe_key, bars_df, symbols, sessions):
+        '''bars_df is raw get_stock_bars output for symbols; sessions are the complete session dates the download covered'''
+        if not sessions:
+            return
+        by_symbol = dict(tuple(bars_df.groupby('symbol', sort=False))) if not bars_df.empty else {}
+        months = {}
+        for day in sessions:
+            months.setdefault(day.strftime('%Y-%m'), set()).add(day)
+        for month, month_sessions in months.items():
+            start, end = self._utc_bounds(min(month_sessions), max(month_sessions))
+            for symbol in symbols:
+                path = self._month_path(timeframe_key, symbol, month)
+                cached_sessions, bars = self._load_month(path)
+                new_bars = by_symbol.get(symbol)
+                if new_bars is not None:
+                    new_bars = new_bars[(new_bars['timestamp'] >= start) & (new_bars['timestamp'] < end)]
+                if bars is not None and not bars.empty: # the written range replaces what was cached for it
+                    bars = bars[(bars['timestamp'] < start) | (bars['timestamp'] >= end)]
+                frames = [f for f in (bars, new_bars) if f is not None and not f.empty]
+                merged = pd.concat(frames, ignore_index=True).sort_values('timestamp', kind='stable') if frames else pd.DataFrame()
+                self._save_month(path, cached_sessions | month_sessions, merged)
+
+
+    def invalidate(self, symbols=None, timeframe_key=None, start_date=None, end_date=None):
+        '''
+        Drop cached sessions, e.g. after a split or dividend changed the adjusted history of a symbol.
+        None means "all" for every argument.
+        '''
+        removed = 0
+        timeframe_keys = [timeframe_key] if timeframe_key else [d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d))]
+        for tf_key in timeframe_keys:
+            tf_dir = os.path.join(self.root, tf_key)
+            if not os.path.isdir(tf_dir):
+                continue
+            symbol_dirs = [s.replace('/', '_') for s in symbols] if symbols else os.listdir(tf_dir)
+            for symbol_dir in symbol_dirs:
+                symbol_path = os.path.join(tf_dir, symbol_dir)
+                if not os.path.isdir(symbol_path):
+                    continue
+                for f in os.listdir(symbol_path):
+                    if not re.fullmatch(r'\d{4}-\d{2}\.pkl', f):
+                        continue
+                    path = os.path.join(symbol_path, f)
+                    sessions, bars = self._load_month(path)
+                    dropped = {day for day in sessions if (start_date is None or day >= start_date) and (end_date is None or day <= end_date)}
+                    if dropped == sessions:
+                        os.remove(path)
+                    elif dropped:
+                        start, end = self._utc_bounds(min(dropped), max(dropped))
+                        if not bars.empty:
+                            bars = bars[(bars['timestamp'] < start) | (bars['timestamp'] >= end)]
+                        self._save_month(path, sessions - dropped, bars)
+                    removed += len(dropped)
+        logger.info(f'Bar cache: {removed} cached sessions invalidated')
+        return removed
+
+
+class TradingCalendar:
+    '''
+    Alpaca trading calendar (session date, open and close as naive ET datetimes) kept in memory and optionally pickled to cache_file.
+    A miss downloads the requested range padded by a year on both sides, so normally the calendar is requested once.
+    A calendar older than max_age_days is downloaded again, so holidays or early closes announced later are picked up.
+    '''
+
+    def __init__(self, trading_client, cache_file=None, max_age_days=30):
+        self.trading_client = trading_client
+        self.cache_file = cache_file
+        self.max_age = dt.timedelta(days=max_age_days)
+        self.sessions_df = pd.DataFrame(columns=['date', 'open', 'close'])
+        self.fetched_on = None # date of the download
+        if cache_file and os.path.exists(cache_file):
+            try:
+                cached = pd.read_pickle(cache_file)
+            except Exception as e: # e.g. truncated file: no fetch date, so downloaded again on first use
+                logger.warning(f'Trading calendar cache {cache_file} not readable, downloading it again: {e}')
+                cached = None
+            if isinstance(cached, dict):
+                self.fetched_on, self.sessions_df = cached['fetched_on'], cached['sessions']
+            elif isinstance(cached, pd.DataFrame): # bare frame of an older cache: no fetch date, refreshed on first use
+                self.sessions_df = cached
+
+
+    def _covers(self, start, end):
+        fresh = self.fetched_on is not None and dt.date.today() - self.fetched_on <= self.max_age
+        return fresh and not self.sessions_df.empty and self.sessions_df['date'].iloc[0] <= start and self.sessions_df['date'].iloc[-1] >= end
+
+
+    def sessions(self, start, end):
+        '''sessions between start and end dates (both inclusive), oldest first'''
+        if not self._covers(start, end):
+            fetch_start = start - dt.timedelta(days=365)
+            fetch_end = end + dt.timedelta(days=365)
+            if not self.sessions_df.empty:
+                fetch_start = min(fetch_start, self.sessions_df['date'].iloc[0])
+                fetch_end = max(fetch_end, self.sessions_df['date'].iloc[-1])
+            calendar = self.trading_client.get_calendar(GetCalendarRequest(start=fetch_start, end=fetch_end))
+            self.sessions_df = pd.DataFrame([(day.date, pd.Timestamp(day.open), pd.Timestamp(day.close)) for day in calendar], columns=['date', 'open', 'close'])
+            self.fetched_on = dt.date.today()
+            logger.info(f'Trading calendar loaded: {len(self.sessions_df)} sessions from {fetch_start} till {fetch_end}')
+            if self.cache_file:
+                _replace_file(self.cache_file, lambda f: pd.to_pickle({'fetched_on': self.fetched_on, 'sessions': self.sessions_df}, f))
+        in_range = (self.sessions_df['date'] >= start) & (self.sessions_df['date'] <= end)
+        return self.sessions_df[in_range].reset_index(drop=True)
+
+
+    def lookback_start(self, periods, bar_minutes, now):
+        '''
+        Timestamp (ET, tz-aware) of the earliest of the latest `periods` regular-session bars before now.
+        bar_minutes=None means daily bars (one bar per session).
+        Intraday bars are counted on the clock grid between open and close, both inclusive as in the market-hours filter of get_history;
+        the bar still forming at `now` is not counted, so the window could be one bar longer than needed, never shorter.
+        '''
+        now = pd.Timestamp(now).tz_convert('America/New_York')
+        today = now.date()
+        lookback_days = 10
+        while True:
+            sessions = self.sessions(today - dt.timedelta(days=lookback_days), today)
+            sessions = sessions[sessions['date'] <= today].iloc[::-1].reset_index(drop=True) # newest first
+            if bar_minutes is None:
+                if len(sessions) >= periods:
+                    return pd.Timestamp(sessions['date'].iloc[periods - 1]).tz_localize('America/New_York')
+            else:
+                open_min = (sessions['open'].dt.hour * 60 + sessions['open'].dt.minute).to_numpy()
+                close_min = (sessions['close'].dt.hour * 60 + sessions['close'].dt.minute).to_numpy()
+                if len(sessions) and sessions['date'].iloc[0] == today: # running session: only bars which are complete by now
+                    now_min = now.hour * 60 + now.minute - bar_minutes
+                    close_min[0] = min(close_min[0], now_min)
+                first_bar = -(-open_min // bar_minutes) * bar_minutes # ceil to the grid
+                last_bar = (close_min // bar_minutes) * bar_minutes
+                bars_per_session = np.maximum(0, (last_bar - first_bar) // bar_minutes + 1)
+                bars_cumulative = np.cumsum(bars_per_session)
+                enough = np.nonzero(bars_cumulative >= periods)[0]
+                if len(enough):
+                    i = enough[0]
+                    remaining = periods - (bars_cumulative[i] - bars_per_session[i])
+                    start_min = int(last_bar[i] - (remaining - 1) * bar_minutes)
+                    return pd.Timestamp(sessions['date'].iloc[i]).tz_localize('America/New_York') + pd.Timedelta(minutes=start_min)
+            if lookback_days > 366 * 30:
+                raise ValueError(f"Trading calendar has not enough sessions for {periods} bars")
+            lookback_days *= 2
+
+
+class AssetMaster:
+    '''
+    Active US equities (one row per symbol, the columns the universe screen needs) kept in memory and pickled to cache_file.
+    They are downloaded again only when the table is older than ttl_seconds, as raw JSON (no pydantic Asset models for 10k+
+    assets). A refresh is diffed against the table: listed, delisted and changed symbols are logged and only new or changed
+    rows are screened again. Between refreshes universe() is a cached list.
+    '''
+
+    COLUMNS = ['symbol', 'name', 'exchange', 'tradable', 'shortable', 'marginable', 'fractionable', 'easy_to_borrow', 'maintenance_margin_requirement']
+    EXCLUDED_NAMES = re.compile('|'.join(re.escape(ex_string) for ex_string in
+                                         ['Etf', 'ETF', 'Lp', 'L.P', 'Fund', 'Trust', 'Depositary', 'Depository', 'Note', 'Reit', 'REIT']))
+
+    def __init__(self, trading_client, cache_file=None, ttl_seconds=12 * 3600):
+        self.trading_client = trading_client
+        self.cache_file = cache_file
+        self.ttl_seconds = ttl_seconds
+        self.assets_df = pd.DataFrame(columns=self.COLUMNS + ['in_scope'])
+        self.refreshed_at = 0.0
+        self._universe = None
+        if cache_file and os.path.exists(cache_file):
+            try:
+                self.refreshed_at, self.assets_df = pd.read_pickle(cache_file)
+            except Exception as e: # e.g. truncated file: refreshed_at stays 0, so refreshed from the API on first use
+                logger.warning(f'Asset master cache {cache_file} not readable, refreshing it: {e}')
+
+
+    @classmethod
+    def screen(cls, assets_df):
+        '''boolean mask of the assets a strategy could trade, one vectorized pass over the table'''
+        flag = lambda column: assets_df[column].fillna(False).astype(bool)
+        return ((assets_df['exchange'] != 'OTC') # OTC stocks play by different rules than Exchange Traded stocks (often referred to as NMS).
+                                                 # Data reporting is even different.
+                                                 # It’s not that one shouldn’t trade OTC stocks but be aware they have different rules.
+                                                 # Perhaps separate OTC stocks in your algo if you wish to trade these.
+                & flag('shortable')
+                & flag('tradable')
+                & flag('marginable') # if a stock is not marginable that means it cannot be used as collateral for margin.
+                                     # As an example, if one had equity of $10,000 one could buy $10,000 of marginable stock and still have $10,000 left in buying power.
+                                     # However, if one were to buy $10,000 of non marginable stock the buying power would be $0 (ie no funds can be margined against that stock).
+                                     # This has ramifications for RegT buying power and Fed margin calls. Best to stay away from these unless your algo carefully monitors RegT buying power.
+                                     # FYI there are currently no tradable exchange traded stocks which are not marginable (so this doesn’t really limit the universe). However, all OTC stocks are non marginable (another reason to perhaps not consider OTC stocks)
+                & flag('fractionable') # indirectly filters out a lot of small volatile stocks:
+                                       # Alpaca Trading Team manually reviews stocks to qualify as ‘fractionable’.
+                                       # This is entirely an Alpaca designation and other brokers may have different ‘fractionable’ stocks
+                & flag('easy_to_borrow') # Alpaca currently uses its clearing firms ‘Easy To Borrow’ list and assumes everything else is Hard To Borrow.
+                & (pd.to_numeric(assets_df['maintenance_margin_requirement'], errors='coerce') == 30)
+                & ~assets_df['name'].astype(str).str.contains(cls.EXCLUDED_NAMES)) # no ETFs, funds, trusts, notes, REITs ...
+
+
+    def refresh(self):
+        raw_assets = self.trading_client.get('/assets', GetAssetsRequest(asset_class=AssetClass.US_EQUITY, status=AssetStatus.ACTIVE).to_request_fields())
+        fresh = pd.DataFrame(raw_assets).reindex(columns=self.COLUMNS).drop_duplicates('symbol').set_index('symbol')
+        previous = self.assets_df.drop_duplicates('symbol').set_index('symbol')
+
+        # diff on the screened columns: unchanged symbols keep their screen result
+        common = fresh.index.intersection(previous.index)
+        old_values, new_values = previous.loc[common, self.COLUMNS[1:]], fresh.loc[common, self.COLUMNS[1:]]
+        same = ((old_values == new_values) | (old_values.isna() & new_values.isna())).all(axis=1)
+        unchanged = common[same.to_numpy()]
+        fresh['in_scope'] = previous['in_scope'].reindex(fresh.index).where(fresh.index.isin(unchanged))
+        to_screen = fresh['in_scope'].isna()
+        fresh.loc[to_screen, 'in_scope'] = self.screen(fresh[to_screen]).to_numpy()
+        fresh['in_scope'] = fresh['in_scope'].astype(bool)
+        logger.info(f'Asset master refreshed: {len(fresh)} assets, {len(fresh.index.difference(previous.index))} listed, '
+                    f'{len(previous.index.difference(fresh.index))} delisted, {len(common) - len(unchanged)} changed, {int(fresh["in_scope"].sum())} in scope')
+
+        self.assets_df = fresh.reset_index()
+        self.refreshed_at = time.time()
+        self._universe = None
+        if self.cache_file:
+            _replace_file(self.cache_file, lambda f: pd.to_pickle((self.refreshed_at, self.assets_df), f))
+
+
+    def universe(self):
+        '''screened symbols; a local lookup unless the table is older than the TTL'''
+        if time.time() - self.refreshed_at > self.ttl_seconds:
+            self.refresh()
+        if self._universe is None:
+            self._universe = self.assets_df.loc[self.assets_df['in_scope'].astype(bool), 'symbol'].tolist()
+        return self._universe
+
+
+class DownloadTuning:
+    '''
+    Threads and chunk size of one download run, adjusted while the run goes:
+    - HTTP 429: threads are halved and the caller backs off before resubmitting the chunk
+    - after every `window` finished requests: threads keep moving in the same direction while rows/second improves, otherwise the direction flips
+    - chunk size follows request latency: much faster than target_latency => bigger chunks, much slower => smaller chunks
+    '''
+
+    def __init__(self, key, num_threads, chunk_size, max_threads, target_latency, window, fixed):
+        self.key = key
+        self.num_threads = num_threads
+        self.chunk_size = chunk_size
+        self.max_threads = max_threads
+        self.target_latency = target_latency
+        self.window = window
+        self.fixed = fixed # explicitly given threads/chunk size are not tuned
+        self.lock = threading.Lock()
+        self.direction = 1
+        self.last_rate = 0
+        self.best = (num_threads, chunk_size, 0)
+        self.consecutive_throttles = 0
+        self.throttled_total = 0
+        self._reset_window()
+
+
+    def _reset_window(self):
+        self.window_started = time.time()
+        self.window_rows = 0
+        self.window_latencies = []
+
+
+    def record(self, latency, rows):
+        with self.lock:
+            self.consecutive_throttles = 0
+            self.window_rows += rows
+            self.window_latencies.append(latency)
+            if len(self.window_latencies) < self.window:
+                return
+            rate = self.window_rows / max(time.time() - self.window_started, 1e-6)
+            if rate > self.best[2]:
+                self.best = (self.num_threads, self.chunk_size, rate)
+            if not self.fixed:
+                if rate < self.last_rate:
+                    self.direction = -self.direction
+                self.num_threads = min(self.max_threads, max(1, self.num_threads + self.direction))
+                mean_latency = sum(self.window_latencies) / len(self.window_latencies)
+                if mean_latency > 1.5 * self.target_latency:
+                    self.chunk_size = max(10, int(self.chunk_size * 0.7))
+                elif mean_latency < 0.5 * self.target_latency:
+                    self.chunk_size = min(1000, int(self.chunk_size * 1.4))
+            self.last_rate = rate
+            self._reset_window()
+
+
+    def throttled(self):
+        '''registers HTTP 429 and returns seconds to wait before the chunk is resubmitted'''
+        with self.lock:
+            self.consecutive_throttles += 1
+            self.throttled_total += 1
+            if not self.fixed:
+                self.num_threads = max(1, self.num_threads // 2)
+                self.direction = -1
+            self.last_rate = 0
+            self._reset_window() # rates measured around a throttle are not comparable
+            return min(60, 2 ** self.consecutive_throttles)
+
+
+class DownloadTuner:
+    '''
+    Remembers the best (threads, chunk size) per timeframe key in a json file, so the next run starts where the last one ended.
+    This replaces the hand timing from ETF_data_parallel.ipynb.
+    '''
+
+    def __init__(self, state_file=None, max_threads=32, target_latency=3.0, window=8, default_threads=8, default_chunk_size=100):
+        self.state_file = state_file
+        self.max_threads = max_threads
+        self.target_latency = target_latency
+        self.window = window
+        self.defaults = {'num_threads': default_threads, 'chunk_size': default_chunk_size, 'rows_per_sec': 0}
+        self.lock = threading.Lock()
+        self.settings = {}
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file) as f:
+                    self.settings = json.load(f)
+            except (OSError, ValueError) as e: # unreadable state only costs the tuning of one run
+                logger.warning(f'Download tuner state {state_file} not readable, starting from defaults: {e}')
+
+
+    def begin(self, key, num_threads=None, chunk_size=None):
+        with self.lock:
+            remembered = self.settings.get(key, self.defaults)
+        fixed = num_threads is not None or chunk_size is not None
+        return DownloadTuning(key,
+                              num_threads if num_threads is not None else remembered['num_threads'],
+                              chunk_size if chunk_size is not None else remembered['chunk_size'],
+                              self.max_threads, self.target_latency, self.window, fixed)
+
+
+    def end(self, tuning):
+        num_threads, chunk_size, rate = tuning.best
+        logger.info(f'Download {tuning.key}: best {rate:.0f} rows/s with {num_threads} threads and chunks of {chunk_size} ({tuning.throttled_total} throttled requests)')
+        if tuning.fixed or rate == 0:
+            return
+        with self.lock:
+            self.settings[tuning.key] = {'num_threads': num_threads, 'chunk_size': chunk_size, 'rows_per_sec': rate}
+            if self.state_file:
+                _replace_file(self.state_file, lambda f: json.dump(self.settings, f, indent=2), mode='w')
+
+
+
+class IndicatorState:
+    '''
+    Per-symbol state of the add_columns features, so a heartbeat only processes the bars newer than its last run (O(new bars)):
+    last bar time, ema, running max (drawdown), streak and its direction, and the last max(span, weekperiod) closes
+    (close weekperiod bars back for ret1w, the rolling volat window). Saved to state_file with one numpy array per field.
+    span/weekperiod are fixed with the state. Bars are consumed oldest first, the only order a state can continue; add_columns
+    without a state computes in time order too, so both give the same values for the same bars (only the rows returned differ).
+        state = IndicatorState(os.path.join(bar_cache_dir, 'indicators_15min.npz'))
+        new_rows = alpaca_instance.add_columns(alpaca_instance.get_history(symbols, periods=570), state=state)
+    '''
+
+    def __init__(self, state_file=None, span=None, weekperiod=None):
+        self.state_file = state_file
+        self.span, self.weekperiod = span, weekperiod
+        self.symbols = np.array([], dtype=str)
+        self.last_timestamp = np.array([], dtype=np.int64) # ns, naive ET as in get_history frames
+        self.ema = np.array([])
+        self.running_max = np.array([])
+        self.streak = np.array([], dtype=np.int64)
+        self.direction = np.array([], dtype=np.int64) # last non-zero direction, continues the streak
+        self.closes = np.empty((0, 0)) # last closes per symbol, oldest first, NaN padded
+        if state_file and os.path.exists(state_file):
+            with np.load(state_file, allow_pickle=False) as saved:
+                self.span, self.weekperiod = int(saved['span']), int(saved['weekperiod'])
+                for field in ('symbols', 'last_timestamp', 'ema', 'running_max', 'streak', 'direction', 'closes'):
+                    setattr(self, field, saved[field])
+        elif span is not None:
+            self.set_windows(span, weekperiod)
+
+
+    def set_windows(self, span, weekperiod):
+        self.span, self.weekperiod = int(span), int(weekperiod)
+        self.closes = np.full((len(self.symbols), max(self.span, self.weekperiod)), np.nan)
+
+
+    def _add_symbols(self, symbols):
+        new_symbols = np.setdiff1d(np.asarray(symbols, dtype=str), self.symbols)
+        if len(new_symbols) == 0:
+            return
+        self.symbols = np.concatenate((self.symbols, new_symbols))
+        self.last_timestamp = np.concatenate((self.last_timestamp, np.full(len(new_symbols), np.iinfo(np.int64).min)))
+        self.ema = np.concatenate((self.ema, np.full(len(new_symbols), np.nan)))
+        self.running_max = np.concatenate((self.running_max, np.full(len(new_symbols), np.nan)))
+        self.streak = np.concatenate((self.streak, np.zeros(len(new_symbols), dtype=np.int64)))
+        self.direction = np.concatenate((self.direction, np.zeros(len(new_symbols), dtype=np.int64)))
+        self.closes = np.concatenate((self.closes, np.full((len(new_symbols), self.closes.shape[1]), np.nan)))
+
+
+    def update(self, df):
+        '''
+        bars (symbol, timestamp, close; any order, may overlap earlier runs) => only the bars newer than the state,
+        sorted by symbol and time, with ema, ret1w, logret, drawdown, volat and streak. The state moves on to the last bars.
+        '''
+        self._add_symbols(df['symbol'].unique())
+        slots = pd.Index(self.symbols).get_indexer(df['symbol'])
+        timestamps = pd.DatetimeIndex(df['timestamp']).as_unit('ns').asi8
+        newer = np.flatnonzero(timestamps > self.last_timestamp[slots])
+        newer = newer[np.lexsort((timestamps[newer], slots[newer]))]
+        rows = df.iloc[newer].reset_index(drop=True)
+        if rows.empty:
+            return rows.assign(ema=[], ret1w=[], logret=[], drawdown=[], volat=[], streak=np.array([], dtype=np.int64))
+        slots, timestamps = slots[newer], timestamps[newer]
+        close = rows['close'].to_numpy(dtype=float)
+
+        # segments: one per symbol, new bars behind the stored closes of that symbol
+        starts = np.flatnonzero(np.concatenate(([True], slots[1:] != slots[:-1])))
+        ends = np.append(starts[1:], len(rows)) - 1
+        segment_slots = slots[starts]
+        tail = self.closes.shape[1]
+        segment_of_row = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(rows))))
+        positions = np.arange(len(rows)) + tail * (segment_of_row + 1)
+        extended_starts = starts + tail * np.arange(len(starts))
+        extended = np.empty(len(rows) + tail * len(starts))
+        extended[positions] = close
+        extended[extended_starts[:, None] + np.arange(tail)] = self.closes[segment_slots]
+
+        logret = np.log1p(segmented_pct_change(extended, extended_starts, 1))
+        features = {
+            'ema': segmented_ewma(close, starts, self.span, initial=self.ema[segment_slots]),
+            'ret1w': segmented_pct_change(extended, extended_starts, self.weekperiod)[positions],
+            'logret': logret[positions],
+        }
+        running_max = segmented_cummax(close, starts, initial=self.running_max[segment_slots])
+        features['drawdown'] = (close - running_max) / running_max
+        features['volat'] = segmented_rolling_std(logret, extended_starts, self.span)[positions]
+        direction = price_direction(features['logret'])
+        features['streak'] = segmented_streak(direction, starts, self.streak[segment_slots], self.direction[segment_slots])
+
+        # state moves on to the last bar of every segment
+        self.ema[segment_slots] = features['ema'][ends]
+        self.running_max[segment_slots] = running_max[ends]
+        self.streak[segment_slots] = features['streak'][ends]
+        last_move = np.cumsum(direction != 0)[ends] - 1 # index of the latest non-zero direction up to the segment end
+        moves = np.flatnonzero(direction)
+        moved = last_move >= 0
+        moved[moved] = segment_of_row[moves[last_move[moved]]] == np.flatnonzero(moved)
+        self.direction[segment_slots[moved]] = direction[moves[last_move[moved]]]
+        extended_ends = ends + tail * (np.arange(len(starts)) + 1)
+        self.closes[segment_slots] = extended[extended_ends[:, None] - np.arange(tail)[::-1]]
+        self.last_timestamp[segment_slots] = timestamps[ends]
+        return rows.assign(**features)
+
+
+    def save(self):
+        if not self.state_file:
+            return
+        with open(self.state_file + '.tmp', 'wb') as f:
+            np.savez(f, span=self.span, weekperiod=self.weekperiod, symbols=self.symbols, last_timestamp=self.last_timestamp, ema=self.ema,
+                     running_max=self.running_max, streak=self.streak, direction=self.direction, closes=self.closes)
+        os.replace(self.state_file + '.tmp', self.state_file) # no half-written state if the heartbeat is killed
+
+
 
 class MyAlpaca:
 
-    def __init__(self, key, secret, strategy_name = 'PaperTesting', max_wait_time=30):
-        self.trading_client = TradingClient(key, secret)
-        self.stock_client = StockHistoricalDataClient(key, secret)
-        self.broker_client = BrokerClient(key, secret,sandbox=False,api_version="v2")
+    def __init__(self, key, secret, strategy_name = 'PaperTesting', max_wait_time=30, bar_cache_dir=os.getenv('bar_cache_dir')):
+        # all REST calls of all strategies in the process share one rate limiter (orders pre-empt bulk downloads)
+        self.trading_client = rate_limiter.attach(TradingClient(key, secret))
+        self.stock_client = rate_limiter.attach(StockHistoricalDataClient(key, secret))
+        self.raw_stock_client = rate_limiter.attach(StockHistoricalDataClient(key, secret, raw_data=True)) # JSON dicts, no pydantic models (bulk quotes)
+        self.broker_client = rate_limiter.attach(BrokerClient(key, secret,sandbox=False,api_version="v2"))
+        self._credentials = (key, secret) # for the optional async market data engine, created on first use
+        self._async_data = None
+        self._async_data_lock = threading.Lock() # first use can come from several download threads at once
+
+        # local bar cache is used by get_history only if a directory is configured (e.g. not on stateless runners)
+        self.bar_cache = BarCache(bar_cache_dir) if bar_cache_dir else None
+        self.calendar = TradingCalendar(self.trading_client, cache_file=os.path.join(bar_cache_dir, 'calendar.pkl') if bar_cache_dir else None,
+                                        max_age_days=int(os.getenv('calendar_max_age_days', 30)))
+        self.download_tuner = DownloadTuner(state_file=os.path.join(bar_cache_dir, 'download_tuning.json') if bar_cache_dir else None)
+        self.asset_master = AssetMaster(self.trading_client, cache_file=os.path.join(bar_cache_dir, 'assets.pkl') if bar_cache_dir else None,
+                                        ttl_seconds=float(os.getenv('asset_master_ttl_hours', 12)) * 3600)
+        self._feature_sets = {} # id(frame) -> (weakref to frame, FeatureSet), see features()
+        self.volume_profile_file = os.getenv('volume_profile_file') or (os.path.join(bar_cache_dir, 'volume_profile.npy') if bar_cache_dir else None)
+        self._volume_profile = (None, None) # (mtime of the file, VolumeProfile)
+        self.spread_quality_file = os.path.join(bar_cache_dir, 'spread_quality.pkl') if bar_cache_dir else None
+        self._spread_quality = (None, None) # ((date, minutes), frame), see spread_quality()
 
         # Get our account information.
         account = self.trading_client.get_account()
@@ -245,6 +970,19 @@ class MyAlpaca:
         return self.stock_client.get_stock_latest_quote(StockLatestQuoteRequest(symbol_or_symbols=symbols,feed=DataFeed.SIP))
 
 
+    def raw_quotes(self, symbols):
+        '''latest quotes as raw JSON: {symbol: {'bp': bid, 'ap': ask, 'bs': ..., 't': ...}}'''
+        return self.raw_stock_client.get_stock_latest_quote(StockLatestQuoteRequest(symbol_or_symbols=symbols,feed=DataFeed.SIP))
+
+
+    def iter_quotes(self, symbols, num_threads=None, chunk_size=None, retries=2, raw=False):
+        '''
+        Latest quotes of many symbols: yields {symbol: Quote} (raw=True: raw JSON dicts) per chunk of symbols as the chunks finish
+        (threads and chunk size autotuned like get_history). Failed chunks are retried `retries` times and then skipped.
+        '''
+        yield from self._download_chunks(symbols, self.raw_quotes if raw else self.quotes, 'latest_quotes', num_threads, chunk_size, retries=retries)
+
+
     def buypower(self):
         '''buying power is 2x equity if 2000 < equity < 25000, and 4x equity if equity > 25000'''
         return float(self.trading_client.get_account().buying_power)
@@ -309,42 +1047,24 @@ class MyAlpaca:
         return investment_distribution
 
 
-    def get_ok_alpaca_stocks(self, spread_limit = 0.01):
+    def get_ok_alpaca_stocks(self, spread_limit = 0.01, estimate = 'latest'):
+        '''
+        Screened universe with spread below spread_limit. estimate: 'latest' for the spread of the latest quote, 'median' or 'p90'
+        of the time-weighted spreads of the previous session (spread_quality: a historical quote download on the first call of
+        the day, so call spread_quality() pre-market before using them in the heartbeat).
+        '''
         try:
-            assets = self.trading_client.get_all_assets(GetAssetsRequest(asset_class=AssetClass.US_EQUITY, status= AssetStatus.ACTIVE))
-            exclude_strings = ['Etf', 'ETF', 'Lp', 'L.P', 'Fund', 'Trust', 'Depositary', 'Depository', 'Note', 'Reit', 'REIT']
-            assets_in_scope = [asset.symbol for asset in assets
-                                if asset.exchange != 'OTC' # OTC stocks play by different rules than Exchange Traded stocks (often referred to as NMS). 
-                                                            # Data reporting is even different. 
-                                                            # It’s not that one shouldn’t trade OTC stocks but be aware they have different rules. 
-                                                            # Perhaps separate OTC stocks in your algo if you wish to trade these. 
-                                and asset.shortable
-                                and asset.tradable
-                                and asset.marginable # if a stock is not marginable that means it cannot be used as collateral for margin. 
-                                                        # As an example, if one had equity of $10,000 one could buy $10,000 of marginable stock and still have $10,000 left in buying power. 
-                                                        # However, if one were to buy $10,000 of non marginable stock the buying power would be $0 (ie no funds can be margined against that stock). 
-                                                        # This has ramifications for RegT buying power and Fed margin calls. Best to stay away from these unless your algo carefully monitors RegT buying power. 
-                                                        # FYI there are currently no tradable exchange traded stocks which are not marginable (so this doesn’t really limit the universe). However, all OTC stocks are non marginable (another reason to perhaps not consider OTC stocks)
-                                and asset.fractionable # indirectly filters out a lot of small volatile stocks:  
-                                                        # Alpaca Trading Team manually reviews stocks to qualify as ‘fractionable’. 
-                                                        # This is entirely an Alpaca designation and other brokers may have different ‘fractionable’ stocks
-                                and asset.easy_to_borrow # Alpaca currently uses its clearing firms ‘Easy To Borrow’ list and assumes everything else is Hard To Borrow. 
-                                and asset.maintenance_margin_requirement == 30
-                                and not (any(ex_string in asset.name for ex_string in exclude_strings))]
-
-            latest_multisymbol_quotes = self.quotes(assets_in_scope)
-            rows = []
-            for symbol, info in latest_multisymbol_quotes.items():
-                try:
-                    spread = (info.ask_price - info.bid_price) / info.ask_price
-                    rows.append({'symbol': symbol, 'spread': spread})
-                except:
-                    continue
-            df_spreads = pd.DataFrame(rows)
+            if estimate == 'latest':
+                # asset screen and latest quotes do not depend on spread_limit, so all strategies of the heartbeat share one download
+                df_spreads = request_coalescer.call(('universe_spreads',), self._universe_spreads)
+                spreads = df_spreads.spread.where(~df_spreads.crossed) # crossed quotes are not trusted
+            else:
+                df_spreads = self.spread_quality()
+                spreads = df_spreads[f'spread_{estimate}']
             # without filtering for spread it will be around 2500 symbols
-            # spread_limit = 0.01 should deliver 550 symbols; 0.002 - around 50 symbols7
-            ok_stocks = df_spreads[df_spreads.spread < spread_limit].symbol.unique().tolist()
-            logger.info(f'There are {len(ok_stocks)} stocks with spread lower than {spread_limit}')
+            # spread_limit = 0.01 should deliver 550 symbols; 0.002 - around 50 symbols7 (latest quote)
+            ok_stocks = df_spreads[spreads < spread_limit].symbol.unique().tolist()
+            logger.info(f'There are {len(ok_stocks)} stocks with {estimate} spread lower than {spread_limit}')
             return ok_stocks
         
         except Exception as e:
@@ -352,21 +1072,81 @@ class MyAlpaca:
             return []  # return an empty list or handle it as needed
 
 
+    def spread_quality(self, minutes: int = None):
+        '''
+        Time-weighted median and p90 spread of the screened universe (symbol, spread_median, spread_p90, quotes, seconds) over
+        short quote windows in the last `minutes` (default env spread_quality_minutes or 10) before the close of the previous
+        session (see _download_spread_quality).
+        Computed once per day, e.g. pre-market, and kept in memory and in bar_cache_dir/spread_quality.pkl.
+        '''
+        minutes = minutes or int(os.getenv('spread_quality_minutes', 10))
+        key = (pd.Timestamp.now(tz='America/New_York').date(), minutes)
+        if self._spread_quality[0] != key:
+            if self.spread_quality_file and os.path.exists(self.spread_quality_file):
+                self._spread_quality = pd.read_pickle(self.spread_quality_file)
+            if self._spread_quality[0] != key:
+                df = request_coalescer.call(('spread_quality',) + key, lambda: self._download_spread_quality(*key))
+                self._spread_quality = (key, df)
+                if self.spread_quality_file:
+                    pd.to_pickle(self._spread_quality, self.spread_quality_file)
+        return self._spread_quality[1]
+
+
+    def _download_spread_quality(self, today, minutes):
+        '''
+        Quotes of a few short windows spread over `minutes` of the previous session, ending spread_quality_close_offset minutes
+        (default 5) before the close so the closing auction does not skew the spreads. Liquid names quote thousands of times a
+        minute, so windows (spread_quality_windows x spread_quality_window_seconds, default 5 x 20s) keep the download small and
+        at most spread_quality_max_quotes (default 2000) quotes per symbol and window are kept.
+        '''
+        sessions = self.calendar.sessions(today - dt.timedelta(days=10), today - dt.timedelta(days=1))
+        close = sessions['close'].iloc[-1].tz_localize('America/New_York')
+        span_end = close - pd.Timedelta(minutes=int(os.getenv('spread_quality_close_offset', 5)))
+        num_windows = int(os.getenv('spread_quality_windows', 5))
+        window_length = pd.Timedelta(seconds=int(os.getenv('spread_quality_window_seconds', 20)))
+        max_quotes = int(os.getenv('spread_quality_max_quotes', 2000))
+        window_ends = [span_end - i * pd.Timedelta(minutes=minutes) / num_windows for i in range(num_windows)]
+        symbols = self.asset_master.universe()
+
+        def fetch_chunk(symbols_chunk):
+            # one small summary frame per chunk, the raw quotes of a window are dropped as soon as they are reduced to arrays
+            parts = []
+            for window_end in window_ends:
+                raw_quotes = self.raw_stock_client.get_stock_quotes(StockQuotesRequest(
+                    symbol_or_symbols=symbols_chunk, start=window_end - window_length, end=window_end, feed=DataFeed.SIP))
+                parts.append(quote_history_arrays(raw_quotes, window_end.value, max_quotes))
+            return time_weighted_spreads(parts)
+
+        # chunks of symbols in parallel (failed chunks retried, then skipped)
+        logger.info(f'Downloading quotes of {len(symbols)} symbols: {num_windows} windows of {window_length} till {span_end}')
+        frames = list(self._download_chunks(symbols, fetch_chunk, 'historical_quotes', retries=2))
+        df = pd.concat(frames, ignore_index=True) if frames else time_weighted_spreads([])
+        logger.info(f'Spread quality of {len(df)} out of {len(symbols)} symbols, {int(df.quotes.sum())} quotes')
+        return df
+
+
+    def _universe_spreads(self):
+        '''screened tradable universe with the spread of its latest quote (symbol, spread, crossed; see quote_spreads.py)'''
+        assets_in_scope = self.asset_master.universe() # cached asset table, screened once per refresh (AssetMaster.screen)
+
+        # latest quotes (raw JSON) in parallel chunks, every chunk goes into the vectorized spread computation as soon as it arrives;
+        # a failing chunk is retried and finally skipped, so the screen loses its symbols only
+        spread_chunks = [latest_spreads(raw_quotes) for raw_quotes in self.iter_quotes(assets_in_scope, retries=2, raw=True)]
+        df_spreads = pd.concat(spread_chunks, ignore_index=True) if spread_chunks else latest_spreads({})
+        logger.info(f'Spreads of {len(df_spreads)} out of {len(assets_in_scope)} screened symbols ({int(df_spreads.crossed.sum())} crossed)')
+        return df_spreads
+
+
     def get_strategy_universe(self):
+        '''universe from the strategy config: 'All' is the screened Alpaca universe, other names are resolved in universe_registry (Universes.py)'''
 
-        strategy_tickers = {
-            'SPY': ['SPY'],
-            'Spiders': ['XLB', 'XLE', 'XLF', 'XLI', 'XLK', 'XLP', 'XLY', 'XLU', 'XLV'],
-            'USAssetClasses': ['XLB', 'XLE'], # adjust
-        }
-        
         # Check if the strategy name is 'All', if so, call get_all_alpaca_stocks
         if self.universe == 'All':
             tickers_in_scope = self.get_ok_alpaca_stocks()
         else:
-            # Return the list of tickers for the given strategy name
-            # If the strategy name is not found, return an empty list
-            tickers_in_scope = strategy_tickers.get(self.universe, [])
+            # Return the list of tickers for the given universe name (e.g. 'SPY', 'Spiders', 'USAssetClasses')
+            # If the universe name is not found, return an empty list
+            tickers_in_scope = universe_registry.resolve(self.universe)
         
         logger.info(f'Strategy {self.strategy_name} has universe {self.universe} ({len(tickers_in_scope)} tickers)')
         return tickers_in_scope
@@ -386,7 +1166,10 @@ class MyAlpaca:
         try:        
             clock = self.trading_client.get_clock()
             today = clock.timestamp # ET date time
-            snap = self.stock_client.get_stock_snapshot(StockSnapshotRequest(symbol_or_symbols=tickers, feed = DataFeed.SIP))
+            # snapshots of the same time bucket only (env snapshot_bucket_seconds, default 60), so a shared snapshot is never older than the bucket
+            snapshot_bucket = int(time.time() // float(os.getenv('snapshot_bucket_seconds', 60)))
+            snap = request_coalescer.call(('snapshot', tuple(sorted(tickers)), snapshot_bucket),
+                                          lambda: self.stock_client.get_stock_snapshot(StockSnapshotRequest(symbol_or_symbols=tickers, feed = DataFeed.SIP)))
             snapshot_data = {stock: [
                                     snapshot.latest_trade.timestamp,                        
                                     snapshot.latest_trade.price, 
@@ -431,11 +1214,37 @@ class MyAlpaca:
             return pd.DataFrame()  # return an empty DataFrame or handle it as neede
 
 
-    def get_history(self, symbols: List[str], periods: int, FrameLength: int = 15, frame: str = 'min', num_threads: int = 8, chunk_size: int = 100, only_for_today = False):
+    def _session_dates(self, start, end):
+        '''trading session dates between start and end (both inclusive) from the Alpaca calendar'''
+        return self.calendar.sessions(start, end)['date'].tolist()
+
+
+    def _to_market_time(self, data_df, only_market=True):
         '''
-        data = alpaca_instance.get_history(symbols=scope,periods=570) # 570 = 15min intervals 26 intervals per day = 1 month of data
-        data = alpaca_instance.get_history(symbols=scope,periods=500,FrameLength=1,frame='day') # daily data
+        UTC bar timestamps => naive ET (market time without +00:00); with only_market just the regular-session bars,
+        open/close per day from the calendar, so early-close days (e.g. 13:00 after Thanksgiving) end at their close.
         '''
+        data_df = data_df.assign(timestamp=to_ny_local(data_df['timestamp']))
+        if only_market and not data_df.empty:
+            local_days = data_df['timestamp'].values.astype('datetime64[D]')
+            sessions = self.calendar.sessions(pd.Timestamp(local_days.min()).date(), pd.Timestamp(local_days.max()).date())
+            data_df = data_df[regular_session_mask(data_df['timestamp'].values, sessions)]
+        return data_df
+
+
+    def invalidate_bar_cache(self, symbols: List[str]=None, FrameLength: int = None, frame: str = None, adjustment = Adjustment.ALL, start_date=None, end_date=None):
+        '''
+        e.g. after a split: alpaca_instance.invalidate_bar_cache(['NVDA'])
+        Without FrameLength/frame all timeframes of the symbols are dropped.
+        '''
+        if self.bar_cache is None:
+            return 0
+        timeframe_key = f'{FrameLength}{frame}_{adjustment.value}' if FrameLength and frame else None
+        return self.bar_cache.invalidate(symbols=symbols, timeframe_key=timeframe_key, start_date=start_date, end_date=end_date)
+
+
+    def _history_timeframe(self, symbols, periods, FrameLength, frame):
+        '''argument checks shared by get_history and iter_history; returns alpaca TimeFrame and bar length in minutes (None for days)'''
         # Type checks
         if not isinstance(symbols, list) or not all(isinstance(s, str) for s in symbols):
             raise TypeError("symbols must be a list of strings")
@@ -450,120 +1259,286 @@ class MyAlpaca:
 
         if frame == 'day':
             InternalFrame = TimeFrameUnit.Day
-            divider = 1
+            bar_minutes = None
         elif frame == 'hour':
             InternalFrame = TimeFrameUnit.Hour
-            divider = 7
+            bar_minutes = 60 * FrameLength
         elif frame == 'min':
             InternalFrame = TimeFrameUnit.Minute
-            divider = 7*60
-      
-        def chunk_symbols(symbols, chunk_size):
-            for i in range(0, len(symbols), chunk_size):
-                yield symbols[i:i + chunk_size]
+            bar_minutes = FrameLength
+        return TimeFrame(FrameLength, InternalFrame), bar_minutes
+
 
-        def fetch_data_for_chunk(symbols_chunk, start_day, end_day, frame):
+    def _history_window(self, periods, FrameLength, bar_minutes, only_for_today):
+        clock = self.trading_client.get_clock()
+        if only_for_today:
+            end_day = start_day =clock.timestamp.replace(hour=9, minute=30, second=0, microsecond=0)
+            days_ago = 0
+        else:                
+            end_day = clock.timestamp
+
+            # Because of weekends, holidays and early closes the start is taken from the trading calendar: ...
+            # ... it is the timestamp of the earliest of the X latest regular-session bars
+            sessions_needed = periods * FrameLength if bar_minutes is None else periods
+            start_day = self.calendar.lookback_start(sessions_needed, bar_minutes, end_day).to_pydatetime()
+            days_ago = (end_day.date() - start_day.date()).days
+        return start_day, end_day, days_ago
+
+
+    def async_market_data(self):
+        '''shared AsyncMarketData engine (one pooled keep-alive session for all calls); needs aiohttp'''
+        if self._async_data is None:
+            with self._async_data_lock:
+                if self._async_data is None: # one engine only: every instance has its own loop thread and session
+                    self._async_data = AsyncMarketData(*self._credentials, rate_limiter=rate_limiter)
+        return self._async_data
+
+
+    def _history_fetcher(self, start_day, end_day, timeframe, timeframe_key, adjustment, use_cache, engine='sdk', intraday=True):
+        '''returns a function downloading raw bars (UTC, all hours) for one chunk of symbols, going through the bar cache if needed'''
+        if engine not in ['sdk', 'async']:
+            raise ValueError("engine must be one of 'sdk', 'async'")
+
+        def fetch_data_for_chunk(symbols_chunk, start_day, end_day):
+            if engine == 'async': # intraday windows are paginated in concurrent weekly slices
+                return self.async_market_data().get_bars(symbols_chunk, start_day, end_day, timeframe=timeframe.value,
+                                                         adjustment=adjustment.value, slice_days=7 if intraday else None)
             bars_request_params = StockBarsRequest(
                 symbol_or_symbols=symbols_chunk,
                 start=start_day, end=end_day,
-                timeframe=TimeFrame(FrameLength, InternalFrame), # e.g. 10 Minutes
-                adjustment=Adjustment.ALL,
+                timeframe=timeframe, # e.g. 10 Minutes
+                adjustment=adjustment,
                 feed=DataFeed.SIP
             )
-            return self.stock_client.get_stock_bars(bars_request_params).df.reset_index()
-
-        try:
-
-            clock = self.trading_client.get_clock()
-            if only_for_today:
-                end_day = start_day =clock.timestamp.replace(hour=9, minute=30, second=0, microsecond=0)
-                days_ago = 0
-            else:                
-                end_day = clock.timestamp
-
-                # Because of weekends and holidays it could be not straightforward to know where last X periods are ...
-                # ... so I first download more-than-needed points and then filter for X latest periods
-                expanded_daysnum = 3
-                days_ago = max(expanded_daysnum,(FrameLength*periods)//divider)
-                start_day = end_day.date() - relativedelta(days=days_ago)
+            bars_df = self.stock_client.get_stock_bars(bars_request_params).df
+            return bars_df.reset_index() if not bars_df.empty else pd.DataFrame()
+
+        if not use_cache:
+            return lambda symbols_chunk: fetch_data_for_chunk(symbols_chunk, start_day, end_day)
+
+        today = end_day.date() # clock is in ET
+        start_date = start_day.date() if isinstance(start_day, dt.datetime) else start_day # cache works on whole sessions
+        complete_sessions = [day for day in self._session_dates(start_date, today) if day < today] # today could be still running => never cached
+
+        def missing_ranges(cached):
+            '''contiguous runs of missing complete sessions as (first, last) dates; the run reaching today and today itself
+            (never cached) are one range (first, None) downloaded till now'''
+            ranges, run = [], []
+            for day in complete_sessions:
+                if day not in cached:
+                    run.append(day)
+                elif run:
+                    ranges.append((run[0], run[-1]))
+                    run = []
+            ranges.append((run[0] if run else today, None))
+            return ranges
+
+        def fetch_cached_chunk(symbols_chunk):
+            # one read of the cached months of the chunk, then only the missing ranges are downloaded,
+            # symbols with the same missing range in one request
+            cached_df, cached_dates = self.bar_cache.read(timeframe_key, symbols_chunk, start_date, today - dt.timedelta(days=1))
+            download_groups = {}
+            for symbol in symbols_chunk:
+                for missing in missing_ranges(cached_dates[symbol]):
+                    download_groups.setdefault(missing, []).append(symbol)
+            fresh_frames, replaced = [], []
+            for (first, last), group_symbols in download_groups.items():
+                range_start, range_end = BarCache._utc_bounds(first, last or today)
+                fresh_df = fetch_data_for_chunk(group_symbols, range_start.to_pydatetime(), end_day if last is None else range_end.to_pydatetime())
+                if not fresh_df.empty and last is not None: # the API end is inclusive
+                    fresh_df = fresh_df[fresh_df['timestamp'] < range_end]
+                self.bar_cache.write(timeframe_key, fresh_df, group_symbols, [day for day in complete_sessions if first <= day <= (last or today)])
+                fresh_frames.append(fresh_df)
+                replaced.append((group_symbols, range_start, range_end))
+            if not cached_df.empty: # a download replaces the cached bars of its range
+                stale = np.zeros(len(cached_df), dtype=bool)
+                for group_symbols, range_start, range_end in replaced:
+                    stale |= cached_df['symbol'].isin(group_symbols).to_numpy() & (cached_df['timestamp'] >= range_start).to_numpy() & (cached_df['timestamp'] < range_end).to_numpy()
+                cached_df = cached_df[~stale]
+            frames = [f for f in [cached_df] + fresh_frames if not f.empty]
+            return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+        return fetch_cached_chunk
+
+
+    def _clean_history(self, data_df, frame, periods):
+        data_df = self._to_market_time(data_df, only_market=frame != 'day') # keep only market hours for intraday bars
+
+        # filter for X latest periods as described above (same order as groupby('symbol').apply(nlargest) had: symbol, newest first)
+        data_df = last_n_per_symbol(data_df, periods)
+        return data_df.reset_index(drop=True)
+
+
+    def _download_chunks(self, symbols, fetch_chunk, tuning_key, num_threads=None, chunk_size=None, retries=None):
+        '''
+        Yields raw frames of symbol chunks as they finish. Threads and chunk size come from the download tuner unless given explicitly.
+        A new chunk is submitted only when a finished one is taken, so at most num_threads chunks are held ahead of the consumer.
+        Chunks rejected with HTTP 429 are resubmitted after a backoff. Other failures raise, or with retries=N the chunk is
+        resubmitted up to N times and then skipped (logged): one bad chunk costs its symbols, not the whole download.
+        '''
+        tuning = self.download_tuner.begin(tuning_key, num_threads, chunk_size)
+        position = 0
+        retry_chunks = []
+        failed_attempts = {}
+
+        def next_chunk():
+            nonlocal position
+            if retry_chunks:
+                return retry_chunks.pop()
+            if position >= len(symbols):
+                return None
+            chunk = symbols[position:position + tuning.chunk_size] # chunk size could change during the run
+            position += len(chunk)
+            return chunk
+
+        def timed_fetch(symbols_chunk):
+            started = time.time()
+            chunk_df = fetch_chunk(symbols_chunk)
+            return chunk_df, time.time() - started
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads or self.download_tuner.max_threads) as executor:
+            pending = {}
+            while True:
+                while len(pending) < tuning.num_threads:
+                    chunk = next_chunk()
+                    if chunk is None:
+                        break
+                    pending[executor.submit(timed_fetch, chunk)] = chunk
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    chunk = pending.pop(future)
+                    try:
+                        chunk_df, latency = future.result()
+                    except Exception as e:
+                        if getattr(e, 'status_code', None) == 429 and tuning.consecutive_throttles < 5:
+                            backoff = tuning.throttled()
+                            logger.warning(f'Rate limit hit, retrying {len(chunk)} tickers in {backoff}s with {tuning.num_threads} threads')
+                            time.sleep(backoff)
+                            retry_chunks.append(chunk)
+                            continue
+                        if retries is None:
+                            raise
+                        attempts = failed_attempts[tuple(chunk)] = failed_attempts.get(tuple(chunk), 0) + 1
+                        if attempts <= retries:
+                            logger.warning(f'Download of {len(chunk)} tickers failed ({e}), retry {attempts}/{retries}')
+                            retry_chunks.append(chunk)
+                        else:
+                            logger.error(f'Download of {len(chunk)} tickers failed {attempts} times, skipped: {e}')
+                        continue
+                    tuning.record(latency, len(chunk_df))
+                    yield chunk_df
+        self.download_tuner.end(tuning)
+
+
+    def get_history(self, symbols: List[str], periods: int, FrameLength: int = 15, frame: str = 'min', num_threads: int = None, chunk_size: int = None, only_for_today = False, adjustment = Adjustment.ALL, engine: str = 'sdk', compact: bool = False):
+        '''
+        data = alpaca_instance.get_history(symbols=scope,periods=570) # 570 = 15min intervals 26 intervals per day = 1 month of data
+        data = alpaca_instance.get_history(symbols=scope,periods=500,FrameLength=1,frame='day') # daily data
+        If the local bar cache is configured, only the sessions missing in the cache (and today) are downloaded.
+        num_threads and chunk_size are autotuned per timeframe unless given (e.g. num_threads=8, chunk_size=100).
+        engine='async' downloads through the aiohttp engine (async_market_data.py) instead of the SDK client.
+        Identical requests of other strategies in the process within the same bar (and coalescing TTL) share one download.
+        compact=True returns compact dtypes (categorical symbol, float32 prices, uint32 counts, see bar_kernels.compact_bars),
+        applied to every chunk as it arrives. Group by symbol with observed=True then.
+        '''
+        timeframe, bar_minutes = self._history_timeframe(symbols, periods, FrameLength, frame)
+        current_bar = int(time.time() // (bar_minutes * 60)) if bar_minutes else dt.date.today() # a new bar always means a new download
+        request_key = ('history', tuple(sorted(symbols)), periods, FrameLength, frame, only_for_today, adjustment.value, engine, compact, current_bar)
+        return request_coalescer.call(request_key, lambda: self._download_history(symbols, periods, FrameLength, frame, timeframe, bar_minutes,
+                                                                                  num_threads, chunk_size, only_for_today, adjustment, engine, compact))
 
 
-            symbols_chunks = chunk_symbols(symbols, chunk_size)
+    def _download_history(self, symbols, periods, FrameLength, frame, timeframe, bar_minutes, num_threads, chunk_size, only_for_today, adjustment, engine, compact=False):
+        try:
+            start_day, end_day, days_ago = self._history_window(periods, FrameLength, bar_minutes, only_for_today)
+            timeframe_key = f'{FrameLength}{frame}_{adjustment.value}' # cache partition, e.g. '5min_all'
+            fetch_chunk = self._history_fetcher(start_day, end_day, timeframe, timeframe_key, adjustment,
+                                                use_cache = self.bar_cache is not None and not only_for_today,
+                                                engine = engine, intraday = bar_minutes is not None)
 
-            dataframes = []
             logger.info(f'Starting concurrent download of {frame} data across {len(symbols)} tickers for {days_ago} days ...')
-            
-            with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-                for df in executor.map(fetch_data_for_chunk, symbols_chunks, repeat(start_day), repeat(end_day), repeat(frame)):
-                    dataframes.append(df)
+            dataframes = [compact_bars(df, symbols) if compact else df
+                          for df in self._download_chunks(symbols, fetch_chunk, timeframe_key, num_threads, chunk_size) if not df.empty]
 
-            data_df = pd.concat(dataframes, ignore_index=True)
-            data_df.timestamp = data_df.timestamp.dt.tz_convert('America/New_York').dt.tz_localize(None) # Convert to market time and remove +00:00
-            if frame != 'day':
-                data_df = data_df[data_df['timestamp'].dt.time.between(pd.to_datetime('09:30:00').time(), pd.to_datetime('16:00:00').time())] # keep only market hours
-            
-            # filter for X latest periods as described above
-            data_df = data_df.groupby('symbol', group_keys=False).apply(lambda x: x.nlargest(periods, 'timestamp'))
+            if not dataframes:
+                logger.warning(f'No {frame} data was downloaded for {len(symbols)} tickers')
+                return pd.DataFrame()
+
+            data_df = self._clean_history(pd.concat(dataframes, ignore_index=True), frame, periods)
 
-            logger.info(f'Done downloading {frame} data. {len(data_df)} rows collected.')
-            return data_df.reset_index(drop=True)
+            logger.info(f'Done downloading {frame} data. {len(data_df)} rows collected. Rate limiter: {rate_limiter.stats()}')
+            return data_df
 
         except Exception as e:
             logger.error(f"Error in get_history: {e}")
             raise
 
 
-    def add_columns(self, df):
-        ''' ema, ret1w, logret, drawdown, volat, streaks'''
-        # Calculate span
-        interval = (df['timestamp'].iloc[1] - df['timestamp'].iloc[0]).total_seconds() / 60
-        intervals_per_day = 1 if interval == 1440 else (6.5 * 60) / interval # Number of intervals per day = Trading hours in a day / interval in hours
-        intervals_num = int(df.groupby('symbol')['close'].count().median()) # there could be symbols with small history: we take the most often length (median)
-        dayz = intervals_num//intervals_per_day
-        span = int(min(dayz//2, 3) * intervals_per_day)
-        weekperiod = int(min(intervals_num,5 * intervals_per_day))
-
-        df['ema'] = df.groupby('symbol')['close'].transform(lambda x: x.ewm(span=span, adjust=False).mean())
-        df['ret1w'] = df.groupby("symbol")["close"].pct_change(weekperiod)
-        # df['logret'] = df.groupby('symbol')['close'].transform(lambda x: np.log(x / x.shift(1))) # Calculate log returns
-        df['logret'] = df.groupby('symbol')['close'].pct_change().apply(np.log1p)
-
-        # Define a function to calculate drawdown
-        def calculate_drawdown(prices):
-            max_prices = prices.cummax()
-            drawdown = (prices - max_prices) / max_prices
-            return drawdown
-
-        # Apply the drawdown calculation
-        df['drawdown'] = df.groupby('symbol')['close'].transform(calculate_drawdown)
-
-        df['volat'] = df.groupby('symbol')['logret'].transform(lambda x: x.rolling(window=span).std()) # calc volat without annualizing as we need just to compare
-
-
-        # Calculate the direction of the price change: +1 for an increase, -1 for a decrease, 0 for no change.
-        df['direction'] = df['logret'].apply(lambda x: 1 if x > 0 else -1 if x < 0 else 0)
-
-        def calculate_cumulative_streaks(series):
-            streak = 0
-            last_direction = 0
-            streaks = []
-            for value in series:
-                if value == 0: # If no change in price, ...
-                    streaks.append(streak) # .. add the current streak value
-                elif value == last_direction: # If the direction is the same as the last one, ...
-                    streak += value # .. # increment or decrement the streak.
-                    streaks.append(streak)
-                else: # If the direction changes, ..
-                    streak = value # ... reset the streak to the current direction
-                    streaks.append(streak)
-                    last_direction = value
-            return streaks
-
-        # Applying the function to each group
-        df['streak'] = df.groupby('symbol')['direction'].transform(calculate_cumulative_streaks)
-        df.drop(columns=['direction'], inplace=True)        
+    def iter_history(self, symbols: List[str], periods: int, FrameLength: int = 15, frame: str = 'min', num_threads: int = None, chunk_size: int = None, only_for_today = False, adjustment = Adjustment.ALL, engine: str = 'sdk', compact: bool = False):
+        '''
+        Same arguments and cleaning as get_history, but yields one frame per chunk of symbols as soon as its download is done.
+        Chunks never split a symbol, so per-symbol aggregates could be computed chunk by chunk:
+            for chunk_df in alpaca_instance.iter_history(symbols=scope, periods=570): ...
+        Only the chunks in flight are downloaded ahead of the consumer, which keeps memory bounded.
+        compact=True: compact dtypes like in get_history (all chunks share the symbol categories).
+        '''
+        timeframe, bar_minutes = self._history_timeframe(symbols, periods, FrameLength, frame)
+        start_day, end_day, days_ago = self._history_window(periods, FrameLength, bar_minutes, only_for_today)
+        timeframe_key = f'{FrameLength}{frame}_{adjustment.value}'
+        fetch_chunk = self._history_fetcher(start_day, end_day, timeframe, timeframe_key, adjustment,
+                                            use_cache = self.bar_cache is not None and not only_for_today,
+                                            engine = engine, intraday = bar_minutes is not None)
+
+        logger.info(f'Starting streamed download of {frame} data across {len(symbols)} tickers for {days_ago} days ...')
+        rows_yielded = 0
+        for chunk_df in self._download_chunks(symbols, fetch_chunk, timeframe_key, num_threads, chunk_size):
+            if chunk_df.empty:
+                continue
+            if compact:
+                chunk_df = compact_bars(chunk_df, symbols)
+            chunk_df = self._clean_history(chunk_df, frame, periods)
+            rows_yielded += len(chunk_df)
+            yield chunk_df
+        logger.info(f'Done streaming {frame} data. {rows_yielded} rows yielded.')
+
 
-        return df
+    def features(self, df):
+        '''
+        FeatureSet of the frame (indicator_registry): every intermediate (prior close, log returns, TR, EMAs...) is computed once
+        per frame and parameters, whoever asks for it during this heartbeat. The frame should not be changed in place afterwards.
+        '''
+        cached = self._feature_sets.get(id(df))
+        if cached is not None and cached[0]() is df:
+            return cached[1]
+        self._feature_sets = {key: value for key, value in self._feature_sets.items() if value[0]() is not None} # frames gone
+        feature_set = FeatureSet(df)
+        self._feature_sets[id(df)] = (weakref.ref(df), feature_set)
+        return feature_set
+
+
+    def add_columns(self, df, state: IndicatorState = None, workers: int = None):
+        '''
+        ema, ret1w, logret, drawdown, volat, streaks, computed per symbol in time order whatever the row order of df.
+        Without a state the columns are added to df (rows as they are); with a state only the bars newer than the state are
+        processed and returned (sorted by symbol and time), see IndicatorState.
+        workers > 1 shards the symbols over that many processes (shared memory, see bar_kernels.parallel_indicator_columns),
+        default from env add_columns_workers (1 = in-process).
+        '''
+        if state is not None:
+            if state.span is None: # first run: the windows add_columns without a state would use for this frame
+                state.set_windows(*indicator_segments(df)[2:])
+            df = state.update(df)
+            state.save()
+            return df
+
+        # One grouping for all features: rows are sorted by symbol and time once (get_history frames are newest first),
+        # every feature is a segmented kernel over that order (bar_kernels.add_indicator_columns) and goes back to the row order.
+        # ema (ewm adjust=False), ret1w (pct_change over weekperiod), logret, drawdown from the running max,
+        # volat (rolling std of logret, not annualized as we need just to compare), streak of up/down moves
+        workers = workers if workers is not None else int(os.getenv('add_columns_workers', 1))
+        return add_indicator_columns(df, workers)
 
 
     def update_database(self):
@@ -583,15 +1558,23 @@ class MyAlpaca:
         current_df, sha = _read_csv_from_github(repo, DB_FILE)
         
         all_tickers = self.get_ok_alpaca_stocks(spread_limit = 0.015)
-        df_6mohist = self.get_history(symbols=all_tickers, periods=14*22*6, FrameLength = 5, frame = 'min')
-        df_6mohist['time_period'] = df_6mohist['timestamp'].dt.time
 
-        # calculating average 30min volume and trades and adding to the db
+        # calculating average volume and trades per 5min slot of the session: the full profile is saved locally (volume_profile()),
+        # the 09:30 slot goes to the db on github as before
         try:
             logger.info(f'Calculating avg volume and trades for {len(all_tickers)} tickers')
 
-            average_df  = df_6mohist.groupby(['symbol', 'time_period']).agg({'volume': 'mean', 'trade_count': 'mean'}).reset_index()
-            average_openning_5min_df = average_df[average_df['time_period'].isin([pd.to_datetime('09:30:00').time()])].reset_index(drop=True)
+            # 6 months of 5min bars are aggregated chunk by chunk (chunks never split a symbol), so the full history is never in memory;
+            # compact dtypes (categorical symbol, float32 prices, uint32 counts) cut the memory of every chunk further
+            profiles = [VolumeProfile.from_bars(df_6mohist)
+                        for df_6mohist in self.iter_history(symbols=all_tickers, periods=14*22*6, FrameLength = 5, frame = 'min', compact = True)]
+            profile = VolumeProfile.concat(profiles)
+            if self.volume_profile_file:
+                profile.save(self.volume_profile_file)
+                logger.info(f'Volume profile of {len(profile)} symbols saved to {self.volume_profile_file}')
+            else:
+                logger.warning('Volume profile not saved: neither bar_cache_dir nor volume_profile_file is set')
+            average_openning_5min_df = profile.slot_frame(0)
             compare_dataframes(current_df, average_openning_5min_df) # show log of comparison
             logger.info(len(average_openning_5min_df))
         except Exception as e:
@@ -600,6 +1583,20 @@ class MyAlpaca:
         _write_df_to_github(repo, DB_FILE, average_openning_5min_df, sha)
 
 
+    def volume_profile(self):
+        '''
+        Volume profile saved by update_database (volume_profile.py), memory-mapped; reloaded only if the file changed.
+            rvol = alpaca_instance.volume_profile().relative_volume('AAPL', now, volume_since_open, cumulative=True)
+        Stored in bar_cache_dir or at env volume_profile_file.
+        '''
+        if not self.volume_profile_file:
+            raise ValueError('No volume profile location: set bar_cache_dir or volume_profile_file')
+        mtime = os.path.getmtime(self.volume_profile_file)
+        if self._volume_profile[0] != mtime:
+            self._volume_profile = (mtime, VolumeProfile.load(self.volume_profile_file))
+        return self._volume_profile[1]
+
+
     def get_history_minute_single(self, symbol, start_time, window = 5, only_market = True):
         '''For a single ticker on window-minutes timeframe'''
         try:
@@ -612,9 +1609,7 @@ class MyAlpaca:
             )
             data_df = self.stock_client.get_stock_bars(bars_request_params).df.reset_index()
             logger.info(f'{len(data_df)} rows were downloaded for {symbol} to get current drawdown.')
-            data_df.timestamp = data_df.timestamp.dt.tz_convert('America/New_York').dt.tz_localize(None) # Convert to market time and remove +00:00
-            if only_market:
-                data_df = data_df[data_df['timestamp'].dt.time.between(pd.to_datetime('09:30:00').time(), pd.to_datetime('16:00:00').time())] # keep only market hours
+            data_df = self._to_market_time(data_df, only_market) # Convert to market time, keep only market hours if asked
 
             return data_df
 
@@ -623,6 +1618,49 @@ class MyAlpaca:
             raise
 
 
+    def get_history_minute_batch(self, fill_times: Dict[str, dt.datetime], window = 5, only_market = True, end_time = None, chunk_size = 200):
+        '''
+        Batched get_history_minute_single: {symbol: start_time} => {symbol: bars since its start_time}.
+        One multi-symbol request from the earliest start (chunks of chunk_size symbols), sliced per symbol locally.
+        end_time defaults to the clock, pass it if the caller already has the clock (one round trip less).
+        '''
+        if not fill_times:
+            return {}
+        try:
+            if end_time is None:
+                end_time = self.trading_client.get_clock().timestamp
+            earliest_start = min(fill_times.values())
+            symbols = list(fill_times.keys())
+            dataframes = []
+            for i in range(0, len(symbols), chunk_size):
+                bars_request_params = StockBarsRequest(
+                    symbol_or_symbols=symbols[i:i + chunk_size],
+                    start=earliest_start, end=end_time,
+                    timeframe=TimeFrame(window, TimeFrameUnit.Minute),
+                    adjustment=Adjustment.ALL,
+                    feed=DataFeed.SIP
+                )
+                bars_df = self.stock_client.get_stock_bars(bars_request_params).df
+                if not bars_df.empty:
+                    dataframes.append(bars_df.reset_index())
+            if not dataframes:
+                return {symbol: pd.DataFrame() for symbol in symbols}
+            data_df = pd.concat(dataframes, ignore_index=True)
+            logger.info(f'{len(data_df)} rows were downloaded for {len(symbols)} tickers to get current drawdown.')
+
+            # every symbol keeps only the bars from its own start time on (same bars a single request from that time would return)
+            symbol_starts = {symbol: pd.Timestamp(start).tz_convert('UTC') for symbol, start in fill_times.items()}
+            data_df = data_df[data_df['timestamp'] >= data_df['symbol'].map(symbol_starts)]
+            data_df = self._to_market_time(data_df, only_market) # Convert to market time, keep only market hours if asked
+
+            history = {symbol: symbol_df.reset_index(drop=True) for symbol, symbol_df in data_df.groupby('symbol', sort=False)}
+            return {symbol: history.get(symbol, pd.DataFrame()) for symbol in symbols}
+
+        except Exception as e:
+            logger.error(f"Error in get_history_minute_batch: {e}")
+            raise
+
+
     def check_trading_day(self):
 
         result = {
@@ -671,7 +1709,7 @@ class MyAlpaca:
         return result
     
 
-    def get_atr_stoploss(self, tickers: List[str]=None):
+    def get_atr_stoploss(self, tickers: List[str]=None, period: int = 14, wilder: bool = False):
         '''
         TR = max( High - Low, High - Previous Close , Low - Previous Close)
         ATR - typically 14 periods
@@ -679,27 +1717,16 @@ class MyAlpaca:
         [Price] minus [1.5x or 2x ATR]
         ATR does not account for price gaps that can occur outside trading hours
         Use ATR stop-losses in conjunction with key support and resistance levels
-        
+        wilder=True uses Wilder's smoothing instead of the simple rolling mean of TR.
+        Vectorized over all symbols (no per-symbol apply), so it is cheap enough for the whole universe (e.g. for position sizing).
+        Returns {symbol: current ATR}.
         '''
 
-        days = 14
-        prices_df = self.get_history(symbols=tickers, periods=3 * days, FrameLength=1, frame = 'day')
-        
+        prices_df = self.get_history(symbols=tickers, periods=3 * period, FrameLength=1, frame = 'day')
+
         if not prices_df.empty:
-            # Calculate TR and ATR per symbol
-            def calculate_tr_and_atr(group, period=14):
-                group['Prior Close'] = group['close'].shift() # Shift 'close' to get the previous close
-                group['TR'] = group[['high', 'Prior Close']].max(axis=1) - group[['low', 'Prior Close']].min(axis=1) # Calculate True Range (TR)
-                group['ATR'] = group['TR'].rolling(window=period, min_periods=1).mean() # ATR as rolling mean of TR    
-                return group
-
-            # Apply the function to each group of symbols
-            prices_df = prices_df.groupby('symbol').apply(calculate_tr_and_atr).reset_index(drop=True)
-            current_atr_df = prices_df.groupby('symbol').last().reset_index() # the rows are sorted from oldest to newest, so we take last row
-            if current_atr_df.empty or 'ATR' not in current_atr_df.columns:
-                raise ValueError("Failed to calculate ATR. Ensure sufficient historical data is available.")
-            
-            atr_dict = current_atr_df.set_index('symbol')['ATR'].to_dict()
+            # TR/ATR from the indicator registry: sorted by symbol and time once, prior close masked at symbol boundaries
+            atr_dict = self.features(prices_df).latest(['atr'], atr_period=period, wilder=wilder)['atr'].to_dict()
             if not atr_dict:
                 raise ValueError("ATR dictionary is empty. Ensure valid data for the specified symbols.")
 
@@ -1033,9 +2060,14 @@ class MyAlpaca:
                             else:
                                 return current_drawdown, None
                             
+                        # one batched download since the earliest fill instead of a request (and a clock call) per position
+                        minute_history = self.get_history_minute_batch({symbol: details[0] for symbol, details in buy_orders_dict.items()}, end_time=clock.timestamp)
+
                         for symbol, details in buy_orders_dict.items():
-                            filled_at = details[0]
-                            data_df = self.get_history_minute_single(symbol, filled_at)
+                            data_df = minute_history.get(symbol, pd.DataFrame())
+                            if data_df.empty:
+                                logger.warning(f"No minute bars for {symbol} since it was bought. Skipping...")
+                                continue
 
                             close_prices = data_df['close']
 
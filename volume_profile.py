@@ -0,0 +1,143 @@
+'''
+Intraday volume profile: per symbol and 5 minute slot of the regular session (78 slots, 09:30 ... 15:55) the mean and median
+volume and trade count of the bars in a history (update_database builds it from 6 months of 5min bars).
+Stored as one .npy file of a structured array (one row per symbol) and memory-mapped on load, so a strategy only reads
+the rows it looks up, and a lookup is a dict access plus an array index:
+    profile = VolumeProfile.load('volume_profile.npy')
+    profile.expected('AAPL', dt.datetime(2025, 1, 2, 9, 35))                 # mean volume of the 09:35 bar
+    profile.relative_volume('AAPL', now, volume_since_open, cumulative=True)  # volume so far / usual volume so far
+Times are naive ET (market time) like get_history frames. Half-day sessions are in the profile like any other day.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+
+SLOT_MINUTES = 5
+OPEN_MINUTE = 9 * 60 + 30
+SLOTS = (16 * 60 - OPEN_MINUTE) // SLOT_MINUTES # 78
+FIELDS = ('volume_mean', 'volume_median', 'trade_count_mean', 'trade_count_median', 'volume_cumulative')
+PROFILE_DTYPE = np.dtype([('symbol', 'U16'), ('bars', np.uint16, SLOTS)] + [(field, np.float32, SLOTS) for field in FIELDS])
+NS_PER_MINUTE = 60 * 10**9
+
+
+def slot_of(when):
+    '''slot of a naive ET time (datetime or time), None outside the regular session'''
+    slot = (when.hour * 60 + when.minute - OPEN_MINUTE) // SLOT_MINUTES
+    return slot if 0 <= slot < SLOTS else None
+
+
+def _segment_medians(values, keys, counts):
+    '''median of values per key (keys in 0..len(counts)), NaN for empty keys'''
+    # values sorted by key, then value: one argsort of key * n + rank of the value (2x faster than np.lexsort)
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[np.argsort(values)] = np.arange(len(values))
+    sorted_values = values[np.argsort(keys * len(values) + ranks)]
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    medians = np.full(len(counts), np.nan)
+    lower = starts[present] + (counts[present] - 1) // 2
+    upper = starts[present] + counts[present] // 2
+    medians[present] = (sorted_values[lower] + sorted_values[upper]) / 2
+    return medians
+
+
+class VolumeProfile:
+
+    def __init__(self, table):
+        self.table = table
+        self.symbol_index = {symbol: row for row, symbol in enumerate(table['symbol'].tolist())}
+
+
+    @classmethod
+    def from_bars(cls, df):
+        '''
+        5min bars (symbol, timestamp as naive ET, volume, trade_count) => profile of their symbols.
+        Bars outside the regular session and bars without volume or trade count are skipped.
+        '''
+        minutes = (df['timestamp'].to_numpy().astype('datetime64[ns]').view('i8') // NS_PER_MINUTE) % 1440
+        volume = df['volume'].to_numpy(dtype=float)
+        trade_count = df['trade_count'].to_numpy(dtype=float)
+        codes, symbols = pd.factorize(df['symbol'].to_numpy(), sort=True)
+        keep = (minutes >= OPEN_MINUTE) & (minutes < OPEN_MINUTE + SLOTS * SLOT_MINUTES) & ~np.isnan(volume) & ~np.isnan(trade_count)
+        keys = codes[keep].astype(np.int64) * SLOTS + (minutes[keep] - OPEN_MINUTE) // SLOT_MINUTES
+        volume, trade_count = volume[keep], trade_count[keep]
+
+        cells = len(symbols) * SLOTS
+        counts = np.bincount(keys, minlength=cells)
+        table = np.zeros(len(symbols), dtype=PROFILE_DTYPE)
+        table['symbol'] = symbols
+        table['bars'] = np.minimum(counts, np.iinfo(np.uint16).max).reshape(-1, SLOTS)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for name, values in (('volume', volume), ('trade_count', trade_count)):
+                table[f'{name}_mean'] = (np.bincount(keys, weights=values, minlength=cells) / counts).reshape(-1, SLOTS)
+                table[f'{name}_median'] = _segment_medians(values, keys, counts).reshape(-1, SLOTS)
+        table['volume_cumulative'] = np.nancumsum(table['volume_mean'], axis=1)
+        return cls(table)
+
+
+    @classmethod
+    def concat(cls, profiles):
+        '''profiles of different symbols (e.g. one per iter_history chunk) => one profile, symbols ascending'''
+        table = np.concatenate([profile.table for profile in profiles]) if profiles else np.zeros(0, dtype=PROFILE_DTYPE)
+        return cls(table[np.argsort(table['symbol'], kind='stable')])
+
+
+    def save(self, path):
+        '''written to a temporary file and renamed, so a strategy never maps a half-written profile'''
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.table), allow_pickle=False)
+        os.replace(path + '.tmp', path)
+
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False))
+
+
+    def __len__(self):
+        return len(self.table)
+
+
+    def __contains__(self, symbol):
+        return symbol in self.symbol_index
+
+
+    def expected(self, symbol, when, field='volume_mean'):
+        '''field (see FIELDS) of the slot containing when, NaN for unknown symbols, empty slots or times outside the session'''
+        row, slot = self.symbol_index.get(symbol), slot_of(when)
+        if row is None or slot is None:
+            return float('nan')
+        return float(self.table[row][field][slot])
+
+
+    def expected_many(self, symbols, when, field='volume_mean'):
+        '''expected for a list of symbols at once (array aligned with symbols)'''
+        rows = np.array([self.symbol_index.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        slot = slot_of(when)
+        values = np.full(len(rows), np.nan)
+        if slot is not None:
+            known = rows >= 0
+            values[known] = self.table[field][rows[known], slot]
+        return values
+
+
+    def relative_volume(self, symbol, when, volume, cumulative=False, median=False):
+        '''
+        volume of the bar at when / its expected volume; cumulative=True: volume since the open / usual volume till the end of
+        the current slot (a still forming bar makes it look low early in the slot). NaN if there is no expectation.
+        '''
+        field = 'volume_cumulative' if cumulative else 'volume_median' if median else 'volume_mean'
+        expected = self.expected(symbol, when, field)
+        return volume / expected if expected > 0 else float('nan')
+
+
+    def slot_frame(self, slot=0):
+        '''mean volume and trade count of one slot as a frame (symbol, time_period, volume, trade_count), e.g. 09:30 for the github db'''
+        minute = OPEN_MINUTE + slot * SLOT_MINUTES
+        present = self.table['bars'][:, slot] > 0 # symbols without a bar in the slot are left out, as in a groupby
+        return pd.DataFrame({'symbol': self.table['symbol'][present].astype(object),
+                             'time_period': pd.Timestamp(2000, 1, 1, minute // 60, minute % 60).time(),
+                             'volume': self.table['volume_mean'][present, slot].astype(np.float64),
+                             'trade_count': self.table['trade_count_mean'][present, slot].astype(np.float64)})
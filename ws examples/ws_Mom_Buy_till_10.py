@@ -11,14 +11,19 @@
     # those positions will be liquidated at market. 
 
 
+import os
+import sys
 import alpaca_trade_api as tradeapi
 import requests
 import time
-from ta import macd
 import numpy as np
 from datetime import datetime, timedelta
 from pytz import timezone
 
+# streaming_indicators.py is in the repo root (this script runs from ws examples/); a copy next to the script is found first
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from streaming_indicators import MACD
+
 # Replace these with your API connection info from the dashboard
 base_url = 'Your API URL'
 api_key_id = 'Your API Key'
@@ -83,6 +88,29 @@ def find_stop(current_value, minute_history, now):
     return current_value * default_stop
 
 
+# MACD lines used by the signals: (fast, slow) -> how many of the latest values are checked
+MACD_LINES = {(12, 26): 3, (40, 60): 2, (13, 21): 1}
+
+
+def init_macds(minute_history):
+    '''
+    Streaming MACD lines per symbol, seeded from the minute history.
+    Before, ta.macd was recomputed over the whole minute history on every second bar; adjust=True keeps its values.
+    '''
+    macds = {}
+    for symbol, history in minute_history.items():
+        closes = history['close'].dropna().tolist()
+        macds[symbol] = {periods: MACD(*periods, keep=keep, output='macd', adjust=True) for periods, keep in MACD_LINES.items()}
+        for line in macds[symbol].values():
+            line.seed(closes)
+    return macds
+
+
+def update_macds(macds, close, replace):
+    for line in macds.values():
+        line.update(close, replace=replace)
+
+
 def run(tickers, market_open_dt, market_close_dt):
     # Establish streaming connection
     conn = tradeapi.StreamConn(base_url=base_url, key_id=api_key_id, secret_key=api_secret)
@@ -98,6 +126,8 @@ def run(tickers, market_open_dt, market_close_dt):
     symbols = [ticker.ticker for ticker in tickers]
     print('Tracking {} symbols.'.format(len(symbols)))
     minute_history = get_1000m_history_data(symbols)
+    macds = init_macds(minute_history)
+    last_minute = {symbol: (minute_history[symbol].index[-1] if len(minute_history[symbol]) else None) for symbol in symbols}
 
     portfolio_value = float(api.get_account().portfolio_value)
 
@@ -189,6 +219,11 @@ def run(tickers, market_open_dt, market_close_dt):
             ]
         minute_history[symbol].loc[ts] = new_data
 
+        # MACD lines follow the minute closes, the current minute is replaced until it is complete
+        if last_minute.get(symbol) is None or ts >= last_minute[symbol]:
+            update_macds(macds[symbol], data.close, replace=ts == last_minute.get(symbol))
+            last_minute[symbol] = ts
+
         # Next, check for existing orders for the stock
         existing_order = open_orders.get(symbol)
         if existing_order is not None:
@@ -237,22 +272,15 @@ def run(tickers, market_open_dt, market_close_dt):
                 volume_today[symbol] > 30000
             ):
                 # check for a positive, increasing MACD
-                hist = macd(
-                    minute_history[symbol]['close'].dropna(),
-                    n_fast=12,
-                    n_slow=26
-                )
+                hist = list(macds[symbol][(12, 26)].values)
                 if (
+                    len(hist) < 3 or
                     hist[-1] < 0 or
                     not (hist[-3] < hist[-2] < hist[-1])
                 ):
                     return
-                hist = macd(
-                    minute_history[symbol]['close'].dropna(),
-                    n_fast=40,
-                    n_slow=60
-                )
-                if hist[-1] < 0 or np.diff(hist)[-1] < 0:
+                hist = list(macds[symbol][(40, 60)].values)
+                if len(hist) < 2 or hist[-1] < 0 or np.diff(hist)[-1] < 0:
                     return
 
                 # Stock has passed all checks; figure out how much to buy
@@ -300,11 +328,7 @@ def run(tickers, market_open_dt, market_close_dt):
             # Sell for a loss if it's fallen below our stop price
             # Sell for a loss if it's below our cost basis and MACD < 0
             # Sell for a profit if it's above our target price
-            hist = macd(
-                minute_history[symbol]['close'].dropna(),
-                n_fast=13,
-                n_slow=21
-            )
+            hist = list(macds[symbol][(13, 21)].values) or [float('nan')] # no value yet: no MACD based sell
             if (
                 data.close <= stop_prices[symbol] or
                 (data.close >= target_prices[symbol] and hist[-1] <= 0) or
@@ -360,6 +384,9 @@ def run(tickers, market_open_dt, market_close_dt):
             data.close,
             data.volume
         ]
+        if last_minute.get(data.symbol) is None or ts >= last_minute[data.symbol]:
+            update_macds(macds[data.symbol], data.close, replace=ts == last_minute.get(data.symbol))
+            last_minute[data.symbol] = ts
         volume_today[data.symbol] += data.volume
 
     channels = ['trade_updates']
@@ -5,18 +5,22 @@
 - Add your API keys to the corresponding lines in infra.yml
   - Your API Key ID should go on line 10 of infra.yml
   - Your API Secret Key should go on line 21 of infra.yml
-- Go to the S3 console and upload the src code to your S3 Bucket
+- Go to the S3 console and upload the src code to your S3 Bucket, streaming_indicators.py (repo root) next to this file
 - In AWS console go to the CloudFormation console and deploy infra.yml
 '''
 
-import numpy as np
-import talib
+import os
+import sys
 import websocket, json
 import boto3
 import alpaca_trade_api as tradeapi
 
+# deployed: streaming_indicators.py next to this file; in the repo: one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from streaming_indicators import RSI
 
-closing_prices = []
+
+rsi = None # streaming RSI (talib.RSI conventions), one O(1) update per bar instead of talib over all closes so far
 in_position = False
 
 
@@ -66,7 +70,7 @@ class Strategy:
         :return: None
         """
 
-        global in_position
+        global in_position, rsi
 
         self.message = message
         self.RSI_PERIOD = RSI_PERIOD
@@ -76,22 +80,16 @@ class Strategy:
         print(self.message)
         open_price = self.message[0]["o"]
         close_price = self.message[0]["c"]
-        closing_prices.append(float(close_price))
+        if rsi is None:
+            rsi = RSI(self.RSI_PERIOD)
+        last_rsi_value = rsi.update(float(close_price)) # None until RSI_PERIOD price changes were seen
 
         print(
             "The close price is {}".format(close_price),
             "The open price is {}".format(open_price),
         )
-        print("Closing prices list: {} ".format(closing_prices))
-
-        if len(closing_prices) > self.RSI_PERIOD:
-            np_closing_prices = np.array(closing_prices)
-            rsi_values = talib.RSI(np_closing_prices, self.RSI_PERIOD)
-
-            print("All rsi's calculated so far: {}".format(rsi_values))
-
-            last_rsi_value = rsi_values[-1]
 
+        if last_rsi_value is not None:
             print("The current rsi value is {}".format(last_rsi_value))
 
             if last_rsi_value > self.RSI_OVERBOUGHT: